@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by the benchmarks: the configuration of the benchmark
+application and the counter of the SQL statements."""
+
+import os
+import tempfile
+from threading import get_ident
+
+from blog import db
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'benchmark.db')
+
+
+class StatementCounter(object):
+    """Counts the SQL statements run on the database engine by the current
+    thread."""
+
+    def __init__(self, engine):
+        self.count = 0
+        self.thread = get_ident()
+        self.engine = engine
+        db.event.listen(engine, 'before_cursor_execute', self.record)
+
+    def stop(self):
+        db.event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, *args):
+        if get_ident() == self.thread:
+            self.count += 1
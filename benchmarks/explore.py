@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the explore page: served from the database against served
+from the recent posts buffer.
+
+It measures, on a temporary SQLite database, the request rate and the SQL
+statements of the first explore pages and of a page deeper than the buffer,
+with the buffer disabled and enabled. The deep page is only measured when
+there are more posts than the buffer holds.
+
+Usage: python benchmarks/explore.py [posts] [requests]
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import BenchmarkConfig, StatementCounter  # noqa: E402
+from blog import create_app, db  # noqa: E402
+from blog.models import Post, User  # noqa: E402
+from blog.pagination import encode_cursor  # noqa: E402
+from blog.recent import RecentPosts  # noqa: E402
+
+PAGES = 3
+
+
+def measure(app, client, urls, requests):
+    """Returns the requests per second and the mean statements of requests
+    to the urls, in turn. The requests are made without an outer application
+    context, like real requests, so that every request gets a new database
+    session."""
+    counter = StatementCounter(db.get_engine(app))
+    start = time.perf_counter()
+    for i in range(requests):
+        response = client.get(urls[i % len(urls)])
+        assert response.status_code == 200, response.status_code
+    elapsed = time.perf_counter() - start
+    counter.stop()
+    return requests / elapsed, counter.count / requests
+
+
+def main(posts=2000, requests=500):
+    posts, requests = int(posts), int(requests)
+    app = create_app(BenchmarkConfig)
+    per_page = app.config['POSTS_PER_PAGE']
+    with app.app_context():
+        db.create_all()
+        users = [User(username='user{}'.format(i),
+                      email='user{}@example.com'.format(i))
+                 for i in range(20)]
+        users[0].set_password('password')
+        db.session.add_all(users)
+        start = datetime.utcnow() - timedelta(days=1)
+        db.session.add_all([Post(body='post {}'.format(i), language='en',
+                                 author=users[i % len(users)],
+                                 timestamp=start + timedelta(seconds=i))
+                            for i in range(posts)])
+        db.session.commit()
+        newest = Post.query.order_by(Post.timestamp.desc(), Post.id.desc())
+        cursors = [encode_cursor(post.timestamp, post.id)
+                   for post in newest.limit(per_page * PAGES)]
+        deep = newest.offset(app.config['RECENT_POSTS_SIZE']).first()
+    first_pages = ['/explore'] + [
+        '/explore?before={}'.format(cursor)
+        for cursor in cursors[per_page - 1:per_page * (PAGES - 1):per_page]]
+    deep_page = ['/explore?before={}'.format(
+        encode_cursor(deep.timestamp, deep.id))] if deep is not None else []
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'user0',
+                                     'password': 'password'})
+
+    rows = []
+    for name, maxsize in (('database', 0),
+                          ('buffer', app.config['RECENT_POSTS_SIZE'])):
+        app.recent_posts = RecentPosts(maxsize=maxsize,
+                                       ttl=app.config['RECENT_POSTS_TTL'])
+        # warm up the fragment cache and the buffer
+        measure(app, client, first_pages + deep_page,
+                len(first_pages + deep_page))
+        rows.append((name, 'first {} pages'.format(len(first_pages))) +
+                    measure(app, client, first_pages, requests))
+        if deep_page:
+            rows.append((name, 'deep page') +
+                        measure(app, client, deep_page, requests))
+
+    print('{} posts, {} posts per page, buffer of {} posts'.format(
+        posts, per_page, app.config['RECENT_POSTS_SIZE']))
+    print('{:<12}{:<16}{:>14}{:>18}'.format(
+        'explore', 'pages', 'requests/s', 'queries/request'))
+    for name, pages, rate, queries in rows:
+        print('{:<12}{:<16}{:>14.0f}{:>18.2f}'.format(
+            name, pages, rate, queries))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
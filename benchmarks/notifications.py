@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the notifications view: 10 second polling against long
+polling.
+
+It measures, on a temporary SQLite database, the time and the SQL statements of one
+notifications request in both modes, then works out the request rate and the
+database load of a number of connected users that receive a notification every
+few minutes.
+
+Usage: python benchmarks/notifications.py [users] [minutes between messages]
+"""
+
+import os
+import sys
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import BenchmarkConfig, StatementCounter  # noqa: E402
+from blog import create_app, db  # noqa: E402
+from blog.models import User  # noqa: E402
+
+POLL_INTERVAL = 10
+REQUESTS = 200
+
+
+def notify(app, user_id, delay):
+    time.sleep(delay)
+    with app.app_context():
+        User.query.get(user_id).add_notification('unread_message_count', 1)
+        db.session.commit()
+
+
+def measure(app, client, user_id, url, wake_after=None):
+    """Returns the mean seconds and statements of a request to the url
+    returned by the url function. The
+    requests are made without an outer application context, like real
+    requests, so that every request gets a new database session."""
+    counter = StatementCounter(db.get_engine(app))
+    elapsed = 0.0
+    for _ in range(REQUESTS):
+        publisher = None
+        if wake_after is not None:
+            publisher = Thread(target=notify, args=(app, user_id, wake_after))
+            publisher.start()
+        start = time.perf_counter()
+        client.get(url())
+        elapsed += time.perf_counter() - start
+        if publisher is not None:
+            publisher.join()
+            elapsed -= wake_after
+    counter.stop()
+    return elapsed / REQUESTS, counter.count / REQUESTS
+
+
+def main(users=1000, message_minutes=5.0):
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        user = User(username='john', email='john@example.com')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'john',
+                                     'password': 'password'})
+    future = time.time() + 3600
+    poll_time, poll_queries = measure(
+        app, client, user_id,
+        lambda: '/notifications?since={}'.format(future))
+    timeout_time, timeout_queries = measure(
+        app, client, user_id,
+        lambda: '/notifications?since={}&wait=0.001'.format(future))
+    wake_time, wake_queries = measure(
+        app, client, user_id,
+        lambda: '/notifications?since={}&wait=10'.format(time.time()),
+        wake_after=0.001)
+
+    max_wait = app.config['NOTIFICATIONS_MAX_WAIT']
+    message_interval = message_minutes * 60
+    # a long polling client makes one request per notification and one
+    # per wait timeout in between
+    timeout_rate = 1 / max_wait
+    wake_rate = 1 / message_interval
+    polling_rate = 1 / POLL_INTERVAL
+    long_poll_queries = (timeout_rate * timeout_queries +
+                         wake_rate * wake_queries) / (timeout_rate + wake_rate)
+    long_poll_time = (timeout_rate * timeout_time +
+                      wake_rate * wake_time) / (timeout_rate + wake_rate)
+    rows = [
+        ('polling every {}s'.format(POLL_INTERVAL), polling_rate,
+         poll_queries, poll_time),
+        ('long polling ({}s wait)'.format(max_wait),
+         timeout_rate + wake_rate, long_poll_queries, long_poll_time),
+    ]
+    print('{:g} connected users, one message every {:g} minutes each'.format(
+        users, message_minutes))
+    print('{:<26}{:>12}{:>16}{:>18}{:>14}'.format(
+        'mode', 'requests/s', 'queries/request', 'queries/user/min',
+        'max req/s'))
+    for name, rate, queries, seconds in rows:
+        print('{:<26}{:>12.1f}{:>16.2f}{:>18.2f}{:>14.0f}'.format(
+            name, users * rate, queries, rate * queries * 60, 1 / seconds))
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:3]])
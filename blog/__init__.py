@@ -7,7 +7,6 @@ import logging
 import os
 from logging.handlers import SMTPHandler, RotatingFileHandler
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
@@ -16,9 +15,11 @@ from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from elasticsearch import Elasticsearch
 from config import Config
+from blog.replicas import RoutingSQLAlchemy, replica_binds
 
-# Initialize Database and migrations extensions
-db = SQLAlchemy()
+# Initialize Database and migrations extensions (the reads of the GET
+# requests may go to read replicas, see blog.replicas)
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 
 # Initialize Flask Login extension
@@ -49,7 +50,11 @@ def create_app(config_class=Config):
     # Register the configuration module
     app.config.from_object(config_class)
 
-    # Register SQLAlchemy and Database migration with the application factory
+    # Register SQLAlchemy and Database migration with the application factory,
+    # along with the read replicas of the database as binds of their own
+    app.config['SQLALCHEMY_BINDS'] = dict(
+        app.config.get('SQLALCHEMY_BINDS') or {},
+        **replica_binds(app.config['DATABASE_REPLICA_URLS']))
     db.init_app(app)
     migrate.init_app(app, db)
 
@@ -59,6 +64,16 @@ def create_app(config_class=Config):
     # Register Flask-Mail with the application factory
     mail.init_app(app)
 
+    # Register the outgoing email queue with the application factory
+    from blog.email import EmailQueue
+    app.email_queue = EmailQueue(
+        app, workers=app.config['EMAIL_WORKERS'],
+        maxsize=app.config['EMAIL_QUEUE_SIZE'],
+        put_timeout=app.config['EMAIL_QUEUE_TIMEOUT'],
+        batch_size=app.config['EMAIL_BATCH_SIZE'],
+        retries=app.config['EMAIL_RETRIES'],
+        retry_delay=app.config['EMAIL_RETRY_DELAY'])
+
     # Register Flask-Bootstrap with the application factory
     bootstrap.init_app(app)
 
@@ -68,10 +83,116 @@ def create_app(config_class=Config):
     # Register Flask-Babel with the application factory
     babel.init_app(app)
 
+    # Register the circuit breakers of the external services with the
+    # application factory
+    from blog.clients import CircuitBreaker, ServiceClient
+    app.circuit_breakers = {
+        name: CircuitBreaker(
+            name, failure_threshold=app.config['CIRCUIT_BREAKER_THRESHOLD'],
+            reset_timeout=app.config['CIRCUIT_BREAKER_RESET'])
+        for name in ('translator', 'elasticsearch')}
+
+    # Register the translation service client with the application factory
+    app.translator = ServiceClient(
+        app.circuit_breakers['translator'],
+        timeout=app.config['TRANSLATOR_TIMEOUT'],
+        pool_size=app.config['SERVICES_POOL_SIZE'])
+
     # Register Elasticasearch with the application factory
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
+    app.elasticsearch = Elasticsearch(
+        [app.config['ELASTICSEARCH_URL']],
+        timeout=app.config['ELASTICSEARCH_TIMEOUT'],
+        maxsize=app.config['SERVICES_POOL_SIZE']) \
         if app.config['ELASTICSEARCH_URL'] else None
 
+    # Register the search results cache with the application factory
+    from blog.cache import Cache
+    app.search_cache = Cache(maxsize=app.config['SEARCH_CACHE_SIZE'],
+                             ttl=app.config['SEARCH_CACHE_TTL'])
+
+    # Register the username and email to user id cache with the application
+    # factory
+    app.user_ids = Cache(maxsize=app.config['USER_IDS_CACHE_SIZE'],
+                         ttl=app.config['USER_IDS_CACHE_TTL'])
+
+    # Register the logged in user cache with the application factory
+    from blog.user_cache import UserCache
+    app.user_cache = UserCache(maxsize=app.config['USER_CACHE_SIZE'],
+                               ttl=app.config['USER_CACHE_TTL']) \
+        if app.config['USER_CACHE_TTL'] else None
+
+    # Register the rendered fragments cache with the application factory
+    from blog.fragments import create_fragment_cache, render_fragment
+    app.fragment_cache = create_fragment_cache(app.config)
+    app.jinja_env.globals['render_fragment'] = render_fragment
+
+    # Register the recent posts buffer with the application factory
+    from blog.recent import RecentPosts
+    app.recent_posts = RecentPosts(maxsize=app.config['RECENT_POSTS_SIZE'],
+                                   ttl=app.config['RECENT_POSTS_TTL'])
+
+    # Register the translations cache with the application factory
+    from blog.translate import TranslationCache
+    app.translation_cache = TranslationCache(
+        maxsize=app.config['TRANSLATION_CACHE_SIZE'])
+
+    # Register the in-process notification publisher with the application
+    # factory
+    from blog.pubsub import NotificationBroker
+    app.notification_broker = NotificationBroker()
+
+    # Register the buffered last seen time tracker with the application
+    # factory
+    from blog.last_seen import LastSeenTracker
+    app.last_seen = LastSeenTracker()
+
+    # Write the buffered last seen times periodically once the application
+    # serves requests
+    if not app.testing:
+        @app.before_first_request
+        def start_last_seen_worker():
+            app.last_seen.start(app)
+
+    # Start the worker that sends the search index updates of the outbox once
+    # the application serves requests (the command-line tools don't need it):
+    # all of them with SEARCH_OUTBOX, or else the ones that failed to reach
+    # Elasticsearch after their commit
+    if app.config['SEARCH_OUTBOX']:
+        search_worker = app.config['SEARCH_OUTBOX_WORKER']
+    else:
+        search_worker = app.config['SEARCH_BACKEND'] == 'elasticsearch' and \
+            app.elasticsearch is not None
+    if search_worker and not app.testing:
+        @app.before_first_request
+        def start_search_worker():
+            from blog.models import SearchOutbox
+            from blog.workers import BackgroundWorker
+            app.search_worker = BackgroundWorker(
+                app, SearchOutbox.drain, app.config['SEARCH_OUTBOX_INTERVAL'])
+            app.search_worker.start()
+
+    # Start the worker that detects the language of the new posts once the
+    # application serves requests (the command-line tools don't need it)
+    if app.config['LANGUAGE_WORKER'] and not app.testing:
+        @app.before_first_request
+        def start_language_worker():
+            from blog.language import detect_pending
+            from blog.workers import BackgroundWorker
+            app.language_worker = BackgroundWorker(
+                app, detect_pending, app.config['LANGUAGE_WORKER_INTERVAL'])
+            app.language_worker.start()
+
+    # Start the worker that checks the counters of the users periodically
+    if app.config['COUNTERS_CHECK_INTERVAL'] and not app.testing:
+        @app.before_first_request
+        def start_counters_checker():
+            from blog.models import check_user_counters
+            from blog.workers import BackgroundWorker
+            app.counters_checker = BackgroundWorker(
+                app, check_user_counters,
+                app.config['COUNTERS_CHECK_INTERVAL'])
+            app.counters_checker.start()
+
     # Register different blueprints with the application factory
     from blog.main import bp as main_bp
     app.register_blueprint(main_bp)
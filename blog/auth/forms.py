@@ -45,13 +45,13 @@ class RegistrationForm(FlaskForm):
 
     def validate_username(self, username):
         """Check if the username already exists in the User database."""
-        user = User.query.filter_by(username=username.data).first()
+        user = User.by_username(username.data, recheck_missing=True)
         if user is not None:
             raise ValidationError(_('Please choose another username'))
 
     def validate_email(self, email):
         """Check if the email already exists in the User database."""
-        user = User.query.filter_by(email=email.data).first()
+        user = User.by_email(email.data, recheck_missing=True)
         if user is not None:
             raise ValidationError(_('Please choose another email address'))
 
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""In-process caching module for Blogger App"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class Cache(object):
+    """Thread-safe least recently used cache holding at most maxsize entries.
+    When ttl (in seconds) is given the entries also expire after that time.
+    The hits and misses counters keep track of the cache efficiency."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the value cached for a key or default if there is none."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and \
+               entry[0] <= monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Caches a value for a key, evicting the least recently used entry
+        when the cache is full."""
+        if self.maxsize <= 0:
+            return
+        expires = monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Removes the value cached for a key, if any."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Removes the entries whose key matches the predicate function and
+        returns their number."""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        """Removes all the entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters along with the cache size."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries)}
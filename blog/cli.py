@@ -43,3 +43,141 @@ def register(app):
                 'pybabel init -i messages.pot -d blog/translations -l ' + lang):
             raise RuntimeError('init command failed')
         os.remove('messages.pot')
+
+    @translate.command()
+    @click.option('--limit', default=100,
+                  help='Number of posts to translate, newest first.')
+    @click.option('--language', 'languages', multiple=True,
+                  help='Destination language (default: all the languages).')
+    def warm(limit, languages):
+        """Pre-warm the translation cache with the newest posts."""
+        from blog.models import Post
+        from blog.translate import translate as translate_text
+        languages = languages or app.config['LANGUAGES']
+        posts = Post.query.filter(Post.language.isnot(None),
+                                  Post.language != '') \
+            .order_by(Post.timestamp.desc()).limit(limit).all()
+        count = 0
+        # The error messages of the translations are localized, which needs
+        # a request context
+        with app.test_request_context():
+            for post in posts:
+                for language in languages:
+                    if language != post.language:
+                        translate_text(post.body, language, post.language)
+                        count += 1
+        stats = app.translation_cache.stats()
+        click.echo('{} translations warmed, {} requested from the service.'
+                   .format(count, stats['db_misses']))
+
+    @app.cli.group()
+    def timeline():
+        """Home timeline commands"""
+        pass
+
+    @timeline.command()
+    def backfill():
+        """Rebuild the home timeline of all users."""
+        from blog import db
+        from blog.models import Timeline
+        count = Timeline.rebuild()
+        db.session.commit()
+        click.echo('Home timeline rebuilt with {} entries.'.format(count))
+
+    @app.cli.group()
+    def posts():
+        """Posts commands"""
+        pass
+
+    @posts.command('detect-languages')
+    @click.option('--processes', type=int, default=None,
+                  help='Number of worker processes (default: one per CPU).')
+    @click.option('--chunk-size', type=int, default=1000,
+                  help='Number of posts detected and updated at once.')
+    def detect_languages(processes, chunk_size):
+        """Detect the language of the posts that have none."""
+        import time
+        from blog.language import backfill
+        start = time.perf_counter()
+
+        def progress(count):
+            click.echo('Detected {} posts'.format(count))
+
+        count = backfill(processes=processes, chunk_size=chunk_size,
+                         progress=progress)
+        elapsed = time.perf_counter() - start
+        click.echo('Detected the language of {} posts in {:.1f}s '
+                   '({:.0f} posts/sec).'.format(
+                       count, elapsed, count / elapsed if elapsed else 0))
+
+    @app.cli.group()
+    def search():
+        """Full-text search commands"""
+        pass
+
+    @search.command()
+    @click.option('--batch-size', type=int, default=None,
+                  help='Number of posts sent in each bulk request.')
+    def reindex(batch_size):
+        """Add all the posts to the search index."""
+        from blog.models import Post
+        total = Post.query.count()
+
+        def progress(count):
+            click.echo('Indexed {}/{} posts'.format(count, total))
+
+        count = Post.reindex(batch_size=batch_size, progress=progress)
+        click.echo('Reindexed {} posts.'.format(count))
+
+    @search.command()
+    @click.option('--watch', is_flag=True,
+                  help='Keep running and send new updates as they come.')
+    def drain(watch):
+        """Send the pending search index updates of the outbox."""
+        import time
+        from blog.models import SearchOutbox
+        count = 0
+        while True:
+            done = SearchOutbox.drain()
+            count += done
+            if not done:
+                if not watch:
+                    break
+                time.sleep(app.config['SEARCH_OUTBOX_INTERVAL'])
+        click.echo('Sent {} search index updates.'.format(count))
+
+    @app.cli.group()
+    def messages():
+        """Private messages commands"""
+        pass
+
+    @messages.command()
+    def reconcile():
+        """Recompute the unread message counters of all users."""
+        from blog import db
+        from blog.models import User
+        count = User.reconcile_unread_counts()
+        db.session.commit()
+        click.echo('Unread message counters recomputed for {} users.'.format(
+            count))
+
+    @app.cli.group()
+    def users():
+        """Users commands"""
+        pass
+
+    @users.command('check-counters')
+    @click.option('--fix', is_flag=True, help='Correct the wrong counters.')
+    def check_counters(fix):
+        """Check the follower, followed and post counters of all users."""
+        from blog import db
+        from blog.models import User
+        wrong = User.check_counters(fix=fix)
+        for id, counters in sorted(wrong.items()):
+            click.echo('User {}: {}'.format(id, ', '.join(
+                '{} is {} instead of {}'.format(field, stored, actual)
+                for field, (stored, actual) in sorted(counters.items()))))
+        if fix:
+            db.session.commit()
+        click.echo('{} users with wrong counters{}.'.format(
+            len(wrong), ', corrected' if fix and wrong else ''))
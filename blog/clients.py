@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Outbound clients module for Blogger App.
+
+The calls to the external services (the translation service and the
+Elasticsearch cluster) go through a circuit breaker, so that a service that
+hangs or fails can't tie up the workers of the application: after a number of
+consecutive failures the breaker opens and the calls fail at once, until a
+trial call succeeds again. The HTTP calls also share a pool of keep-alive
+connections and are bounded by a timeout."""
+
+from threading import Lock
+from time import monotonic
+from flask import current_app
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class CircuitBreaker(object):
+    """Thread-safe circuit breaker of an external service.
+
+    The breaker is closed while the service works. It opens after
+    failure_threshold consecutive failures, and then rejects the calls for
+    reset_timeout seconds. After that, it is half-open: a single trial call is
+    let through, which closes the breaker again when it succeeds and opens it
+    for another reset_timeout when it fails."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        """Returns the current state of the breaker."""
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if monotonic() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        """Returns whether a call may be made to the service. A call that is
+        allowed must be followed by either success or failure."""
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        """Records a successful call, which closes the breaker."""
+        with self._lock:
+            self.successes += 1
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        """Records a failed call, which opens the breaker once there were
+        failure_threshold of them in a row or when it was the trial call."""
+        with self._lock:
+            self.failures += 1
+            self._consecutive_failures += 1
+            if self._trial or self._opened_at is None and \
+               self._consecutive_failures >= self.failure_threshold:
+                self._opened_at = monotonic()
+                self._trial = False
+                self.opened += 1
+                opened = True
+            else:
+                opened = False
+        if opened:
+            current_app.logger.warning('Circuit breaker of %s opened',
+                                       self.name)
+
+    def call(self, function, *args, **kwargs):
+        """Calls a function that uses the service and returns its result.
+        Raises CircuitOpenError when the breaker is open, and records any
+        exception raised by the function as a failure before raising it."""
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.failure()
+            raise
+        self.success()
+        return result
+
+    def stats(self):
+        """Returns the state of the breaker along with its counters."""
+        return {'state': self.state, 'successes': self.successes,
+                'failures': self.failures, 'rejected': self.rejected,
+                'opened': self.opened}
+
+
+class ServiceClient(object):
+    """HTTP client of an external service. The requests share a session
+    with a pool of pool_size keep-alive connections, time out after timeout
+    seconds unless told otherwise, and go through the circuit breaker of the
+    service. Server errors (5xx) count as failures of the service."""
+
+    def __init__(self, breaker, timeout=5, pool_size=10):
+        self.breaker = breaker
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        """Sends a request and returns its response. Raises CircuitOpenError
+        when the breaker of the service is open and the exceptions of the
+        requests library when the request fails."""
+        kwargs.setdefault('timeout', self.timeout)
+
+        def send():
+            response = self.session.request(method, url, **kwargs)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            return response
+
+        return self.breaker.call(send)
+
+    def post(self, url, **kwargs):
+        """Sends a POST request (see request)."""
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Returns the state and the counters of the circuit breaker."""
+        return self.breaker.stats()
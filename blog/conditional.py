@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Conditional GET module for Blogger App. It lets browsers and proxies keep
+the pages they have already downloaded, and get a '304 Not Modified' answer
+instead of the whole page when it hasn't changed.
+
+The responses are validated with an entity tag (ETag) only. A last
+modification time (Last-Modified) can't stand for the unread messages of the
+current user, the locale or the CSRF token of the pages, so a client sending
+only If-Modified-Since would get a stale page back."""
+
+from functools import wraps
+from hashlib import md5
+from time import time
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+
+
+def conditional(version):
+    """Decorator for the views whose GET responses can be validated with an
+    entity tag (ETag).
+
+    The version function is called with the arguments of the view before the
+    view itself. It returns a cheap token of the data shown by the view, or
+    returns None when the response can't be validated. The entity tag is made of the token, the
+    URL, the current user and the locale. When the request is answered with a
+    304 response, the view isn't called at all."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            token = version(*args, **kwargs)
+            if token is None:
+                return view(*args, **kwargs)
+            etag = _etag(token)
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def csrf_period():
+    """Returns the number of the current half of the CSRF token lifetime. The
+    entity tags of the responses holding a form change with it, so that a
+    revalidated response never holds an expired CSRF token."""
+    csrf_lifetime = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    return int(time() // (csrf_lifetime / 2))
+
+
+def _etag(token):
+    """Returns the entity tag of a response for the data token of its view.
+    Besides the data, the pages show the username and the unread messages of
+    the current user in their navigation bar, and their forms hold a CSRF
+    token that expires (see csrf_period)."""
+    user = (current_user.id, current_user.username,
+            current_user.unread_count) \
+        if current_user.is_authenticated else None
+    return md5(repr((token, request.full_path, user, g.get('locale'),
+                     csrf_period())).encode('utf-8')).hexdigest()
@@ -3,28 +3,178 @@
 
 """Email Support Module. It allows to send email for registered users
 when errors occur. Errors can be forgotten password, app failure,
-notifications and many other conditions."""
+notifications and many other conditions.
 
-from threading import Thread
+The emails are not sent by the requests themselves: they are put in a
+bounded queue drained by a fixed pool of worker threads, which send the
+emails queued together over a single SMTP connection."""
+
+import atexit
+import smtplib
+import time
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
 from flask import current_app
 from flask_mail import Message
 from blog import mail
 
 
-def send_async_email(app, msg):
-    """Function that sends an email to a user asynchronously through
-    the Blogger app call."""
-    with app.app_context():
-        mail.send(msg)
+class EmailQueue(object):
+    """Bounded queue of emails sent by a fixed pool of worker threads.
+
+    Keyword Arguments:
+    app -- The application whose mail settings are used
+    workers -- Number of worker threads, started with the first email
+    maxsize -- Number of emails the queue holds at most. Putting an email in
+    a full queue waits for put_timeout seconds, and gives up after that
+    batch_size -- Number of queued emails sent over one SMTP connection
+    retries -- Number of times the emails are sent again after a transient
+    failure (a 4xx answer of the server or a connection error), waiting
+    retry_delay seconds and twice as long after every failure
+    """
+
+    def __init__(self, app, workers=2, maxsize=1000, put_timeout=5,
+                 batch_size=20, retries=3, retry_delay=1):
+        self.app = app
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self._queue = Queue(maxsize)
+        self._threads = []
+        self._lock = Lock()
+
+    def put(self, msg):
+        """Queues an email to be sent. Returns False when the queue stayed
+        full for put_timeout seconds and the email has been dropped."""
+        self.start()
+        try:
+            self._queue.put(msg, timeout=self.put_timeout)
+        except Full:
+            with self._lock:
+                self.rejected += 1
+            self.app.logger.error('Email queue full, dropped email to %s',
+                                  ', '.join(msg.recipients))
+            return False
+        with self._lock:
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def start(self):
+        """Starts the worker threads unless they are running already. The
+        queue is flushed when the process exits."""
+        with self._lock:
+            if self._threads:
+                return
+            self._threads = [Thread(target=self._run, daemon=True)
+                             for _ in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Sends the emails left in the queue and stops the worker threads.
+        It blocks until they are done."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        atexit.unregister(self.stop)
+
+    def flush(self):
+        """Waits until all the queued emails have been sent."""
+        self._queue.join()
+
+    def stats(self):
+        """Returns the queue depth along with the counters of the emails."""
+        return {'depth': self._queue.qsize(), 'max_depth': self.max_depth,
+                'sent': self.sent, 'failed': self.failed,
+                'retried': self.retried, 'rejected': self.rejected,
+                'workers': len(self._threads)}
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if None in batch:
+                # Every worker is stopped by its own None, so the extra ones
+                # belong to the other workers
+                stopping = True
+                extra = batch.count(None) - 1
+                batch = [msg for msg in batch if msg is not None]
+                for _ in range(extra):
+                    self._queue.put(None)
+                    self._queue.task_done()
+                self._queue.task_done()
+            if batch:
+                try:
+                    self._send(batch)
+                except Exception:
+                    self.app.logger.exception('Email worker failed')
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send(self, batch):
+        """Sends a batch of emails over one SMTP connection, opening a new one
+        to retry the emails left after a transient failure."""
+        pending = list(batch)
+        attempts = 0
+        while pending:
+            try:
+                with self.app.app_context(), mail.connect() as connection:
+                    while pending:
+                        try:
+                            connection.send(pending[0])
+                        except smtplib.SMTPRecipientsRefused as e:
+                            self._failed(pending[0], e)
+                        except smtplib.SMTPResponseException as e:
+                            if e.smtp_code < 500:
+                                raise
+                            self._failed(pending[0], e)
+                        else:
+                            with self._lock:
+                                self.sent += 1
+                        pending.pop(0)
+            except (smtplib.SMTPException, OSError) as e:
+                attempts += 1
+                if attempts > self.retries:
+                    for msg in pending:
+                        self._failed(msg, e)
+                    return
+                with self._lock:
+                    self.retried += 1
+                self.app.logger.warning('Sending email failed, retrying: %s',
+                                        e)
+                time.sleep(self.retry_delay * 2 ** (attempts - 1))
+
+    def _failed(self, msg, error):
+        with self._lock:
+            self.failed += 1
+        self.app.logger.error('Sending email to %s failed: %s',
+                              ', '.join(msg.recipients), error)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     """Function to send registered users an email for any purpose.
     The function inherists from flask_mail Message class attributes and
-    use the mail object defined in the blog app to send the email message
+    puts the email message in the email queue of the blog app, which sends
+    it in the background. Returns False when the queue is full and the
+    email has been dropped.
     """
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start()
+    return current_app.email_queue.put(msg)
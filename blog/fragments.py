@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Rendered fragments caching module for Blogger App.
+
+The templates rendered many times per page, such as '_post.html', are cached
+once rendered. A fragment is keyed by its template, the ids and versions of
+the rows it shows and the locale. The version of a row is a random token
+that is replaced whenever the row changes (see the session events of
+blog.models), so the fragments of a changed row are never found again and
+just age out of the cache."""
+
+import pickle
+from hashlib import md5
+from uuid import uuid4
+from flask import Markup, current_app, g, render_template
+from blog.cache import Cache
+from blog.conditional import csrf_period
+
+
+class RedisBackend(object):
+    """Cache backend shared by all the application processes, kept in a
+    Redis server. It needs the redis package, which isn't installed with the
+    application."""
+
+    def __init__(self, url, ttl=None):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key):
+        return 'fragment:' + ':'.join(str(part) for part in key)
+
+    def get(self, key, default=None):
+        value = self.client.get(self._key(key))
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self._key(key), pickle.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+
+class FragmentCache(object):
+    """Cache of rendered template fragments, kept in a backend with the get,
+    set and delete methods of blog.cache.Cache: either a Cache, private to
+    the process, or a RedisBackend, shared by all the processes."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, table, id):
+        """Returns the current version token of a row. A row without a token,
+        because it was never rendered or its token was evicted, gets a new one
+        so that no fragment rendered before can match it."""
+        key = ('version', table, id)
+        version = self.backend.get(key)
+        if version is None:
+            version = uuid4().hex
+            self.backend.set(key, version)
+        return version
+
+    def invalidate(self, rows):
+        """Drops the version tokens of the changed (table, id) rows, which
+        invalidates all their fragments at once."""
+        for table, id in rows:
+            self.backend.delete(('version', table, id))
+
+    def render(self, template, depends_on=(), **context):
+        """Renders a template with a context of model instances, or returns
+        the cached fragment rendered for the same rows in the same locale.
+        The fragment is also rendered again when any of the depends_on model
+        instances changes."""
+        rows = [(obj.__tablename__, obj.id)
+                for obj in list(context.values()) + list(depends_on)]
+        key = (template,
+               tuple((name, obj.id) for name, obj in sorted(context.items())),
+               tuple(self.version(table, id) for table, id in rows),
+               g.get('locale'))
+        html = self.backend.get(key)
+        if html is None:
+            self.misses += 1
+            html = render_template(template, **context)
+            self.backend.set(key, html)
+        else:
+            self.hits += 1
+        return Markup(html)
+
+    def etag(self, *objs):
+        """Returns an entity tag that changes whenever any of the model
+        instances or the locale changes. It also changes with the CSRF token
+        lifetime, as the fragments hold forms."""
+        versions = [self.version(obj.__tablename__, obj.id) for obj in objs]
+        versions.append(str(g.get('locale')))
+        versions.append(str(csrf_period()))
+        return md5(':'.join(versions).encode('utf-8')).hexdigest()
+
+    def stats(self):
+        """Returns the fragment hit and miss counters."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def create_fragment_cache(config):
+    """Returns the fragment cache chosen by the FRAGMENT_CACHE_* settings."""
+    if config['FRAGMENT_CACHE_URL']:
+        return FragmentCache(RedisBackend(config['FRAGMENT_CACHE_URL'],
+                                          ttl=config['FRAGMENT_CACHE_TTL']))
+    return FragmentCache(Cache(maxsize=config['FRAGMENT_CACHE_SIZE'],
+                               ttl=config['FRAGMENT_CACHE_TTL']))
+
+
+def render_fragment(template, depends_on=(), **context):
+    """Renders a template fragment through the fragment cache of the
+    application (see FragmentCache.render). It is available in the
+    templates."""
+    return current_app.fragment_cache.render(template, depends_on, **context)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Language detection module for Blogger App.
+
+The language of the posts is detected out of the request path: the posts are
+saved without a language, and a background worker woken up after they are
+committed detects it. The posts created before languages existed are
+backfilled with a pool of processes (see the 'flask posts detect-languages'
+command)."""
+
+import os
+from multiprocessing import Pool
+from guess_language import guess_language
+from blog import db
+from blog.models import Post, record_changed_rows
+
+
+def detect_language(text):
+    """Returns the language code of a text, or an empty string when it
+    can't be detected."""
+    language = guess_language(text or '')
+    if language == 'UNKNOWN' or len(language) > 5:
+        return ''
+    return language
+
+
+def detect_languages(rows):
+    """Returns the (id, language) pairs of a list of (id, text) rows. It is
+    the function the backfill runs in its worker processes."""
+    return [(id, detect_language(text)) for id, text in rows]
+
+
+def update_languages(languages):
+    """Writes a dictionary of post languages by post id with a single UPDATE
+    statement."""
+    table = Post.__table__
+    db.session.execute(table.update().where(
+        table.c.id.in_(list(languages))).values(
+            language=db.case(languages, value=table.c.id)))
+    record_changed_rows(db.session, 'post', languages)
+
+
+def pending_posts(limit, after=0):
+    """Returns the (id, body) rows of the next posts without a language."""
+    return db.session.query(Post.id, Post.body).filter(
+        Post.language == None, Post.id > after).order_by(  # noqa: E711
+            Post.id).limit(limit).all()
+
+
+def detect_pending(batch_size=100):
+    """Detects the language of a batch of posts that have none yet. It is the
+    job of the language detection worker, and returns the number of posts
+    detected."""
+    rows = pending_posts(batch_size)
+    if not rows:
+        return 0
+    update_languages(dict(detect_languages(rows)))
+    db.session.commit()
+    return len(rows)
+
+
+def backfill(processes=None, chunk_size=1000, progress=None):
+    """Detects the language of all the posts that have none, spreading
+    chunks of chunk_size posts over a pool of processes (as many as CPUs by
+    default). Every chunk is written with a single UPDATE statement as soon
+    as it is detected. The optional progress function is called with the
+    number of posts detected so far after each chunk. Returns the number of
+    posts detected."""
+    processes = processes or os.cpu_count() or 1
+    count = 0
+    last_id = 0
+    with Pool(processes) as pool:
+        while True:
+            rows = pending_posts(chunk_size * processes, after=last_id)
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            chunks = [rows[i:i + chunk_size]
+                      for i in range(0, len(rows), chunk_size)]
+            for languages in pool.imap_unordered(detect_languages, chunks):
+                update_languages(dict(languages))
+                db.session.commit()
+                count += len(languages)
+                if progress:
+                    progress(count)
+    return count
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Last seen time tracking module for Blogger App.
+
+Instead of writing the 'last_seen' field of the User model on every request,
+the request times are buffered in memory and written for many users at once
+with a single UPDATE statement."""
+
+import atexit
+from datetime import datetime, timedelta
+from threading import Lock
+from flask import current_app
+from blog import db
+from blog.workers import BackgroundWorker
+
+
+class LastSeenTracker(object):
+    """Buffers the last seen times of users and writes them in bulk.
+
+    A user is only buffered again when the last recorded time is older than
+    the LAST_SEEN_STALENESS setting (in seconds). The buffer is written when
+    it holds LAST_SEEN_FLUSH_THRESHOLD users or when LAST_SEEN_FLUSH_INTERVAL
+    seconds have passed since the last write, whichever comes first; once
+    started, a background worker also writes it every
+    LAST_SEEN_FLUSH_INTERVAL seconds and when the process exits. The write
+    uses its own connection, so the request session never starts a write
+    transaction for it."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pending = {}
+        self._last_flush = datetime.utcnow()
+        self._worker = None
+
+    def last_seen(self, user):
+        """Returns the most recent known last seen time of a user."""
+        with self._lock:
+            return self._pending.get(user.id) or user.last_seen
+
+    def touch(self, user, now=None):
+        """Records that a user has been seen now."""
+        now = now or datetime.utcnow()
+        config = current_app.config
+        staleness = timedelta(seconds=config['LAST_SEEN_STALENESS'])
+        interval = timedelta(seconds=config['LAST_SEEN_FLUSH_INTERVAL'])
+        with self._lock:
+            seen = self._pending.get(user.id) or user.last_seen
+            if seen is not None and now - seen < staleness:
+                return
+            self._pending[user.id] = now
+            if len(self._pending) < config['LAST_SEEN_FLUSH_THRESHOLD'] and \
+               now - self._last_flush < interval:
+                return
+        self.flush()
+
+    def start(self, app):
+        """Starts the worker that writes the buffer of the application every
+        LAST_SEEN_FLUSH_INTERVAL seconds, unless it is running already. The
+        buffer is written when the process exits."""
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = BackgroundWorker(
+                app, self.flush, app.config['LAST_SEEN_FLUSH_INTERVAL'])
+        self._worker.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops the worker and writes what is left in the buffer."""
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is None:
+            return
+        worker.stop()
+        with worker.app.app_context():
+            self.flush()
+        atexit.unregister(self.stop)
+
+    def flush(self):
+        """Writes all the buffered last seen times with a single UPDATE
+        statement and returns the number of users written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = datetime.utcnow()
+        if not pending:
+            return 0
+        table = db.metadata.tables['user']
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(
+                table.c.id.in_(list(pending))).values(
+                    last_seen=db.case(pending, value=table.c.id)))
+        current_app.fragment_cache.invalidate(
+            ('user', id) for id in pending)
+        if current_app.user_cache is not None:
+            current_app.user_cache.invalidate(pending)
+        return len(pending)
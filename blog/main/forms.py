@@ -53,7 +53,7 @@ class EditUserProfileForm(FlaskForm):
         a username that is already present in the username field within the
         User model."""
         if username.data != self.original_username:
-            user = User.query.filter_by(username=username.data).first()
+            user = User.by_username(username.data, recheck_missing=True)
             if user is not None:
                 raise ValidationError(_('Please use a different username'))
 
@@ -12,12 +12,14 @@ from flask import (
     request,
     g,
     jsonify,
-    current_app
+    current_app,
+    make_response,
+    abort
 )
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
 from blog import db
+from blog.conditional import conditional
 from blog.main.forms import (
     EditUserProfileForm,
     EmptyForm,
@@ -25,44 +27,99 @@ from blog.main.forms import (
     SearchForm,
     MessageForm,
 )
-from blog.models import User, Post, Message, Notification
-from blog.translate import translate
+from blog.models import User, Post, Message, Notification, author_loader
+from blog.pagination import keyset_paginate
+from blog.replicas import use_primary
+from blog.translate import translate, translate_many
+from blog.user_cache import fresh_user
 from blog.main import bp
 
 
 @bp.before_request
 def before_request():
-    """Record the time of any request done by an authenticated user and
-    stores it to the 'last_seen' field in the User model"""
+    """Record the time of any request done by an authenticated user. The time
+    is buffered and written in bulk to the 'last_seen' field in the User model
+    so that requests don't write to the database themselves."""
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.last_seen.touch(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+def feed_version(query):
+    """Returns the version token of a feed: the (timestamp, id) keys of its
+    newest post, or an empty tuple when the feed is empty."""
+    post = query.first()
+    return (post.timestamp, post.id) if post is not None else ()
+
+
+def index_version():
+    """Version of the home page: its newest post and the number of users the
+    current user follows."""
+    return feed_version(current_user.followed_posts()), \
+        current_user.followed_count
+
+
+def user_version(username):
+    """Version of a profile page: the newest post and the profile of the
+    user, and whether the current user follows him (her)."""
+    user = User.by_username(username)
+    if user is None:
+        return None
+    token = feed_version(
+        user.posts.order_by(Post.timestamp.desc(), Post.id.desc()))
+    following = current_user.is_following(user) \
+        if current_user.is_authenticated and current_user != user else None
+    return (token, user.username, user.email_digest, user.about_me,
+            user.last_seen, user.follower_count, user.followed_count,
+            following)
+
+
+def explore_version():
+    """Version of the explore page: the newest post of all, taken from the
+    recent posts buffer when possible."""
+    newest = current_app.recent_posts.page(1)
+    if newest is None:
+        return feed_version(Post.query.order_by(Post.timestamp.desc(),
+                                                Post.id.desc()))
+    return (newest.items[0].timestamp, newest.items[0].id) \
+        if newest.items else ()
+
+
+def notifications_version():
+    """Version of the notifications of the current user: the time of the
+    newest one. The long polling requests wait for new notifications
+    instead."""
+    if request.args.get('wait', 0.0, type=float) > 0:
+        return None
+    return (db.session.query(db.func.max(Notification.timestamp)).filter(
+        Notification.user_id == current_user.id).scalar(),)
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@conditional(index_version)
 def index():
     """Home page view function"""
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post = Post(body=form.post.data, author=current_user,
-                    language=language)
+        # The language of the post is detected by a background worker
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        db.session.flush()
+        post.fan_out()
         db.session.commit()
         flash(_('Your post is now live'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) \
+    posts = keyset_paginate(
+        current_user.followed_posts().options(author_loader(Post)),
+        User.followed_posts_keys(),
+        current_app.config['POSTS_PER_PAGE'],
+        before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.index', before=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', after=posts.prev_cursor) \
         if posts.has_prev else None
     return render_template('index.html', title=_("Home"), form=form,
                            posts=posts.items, next_url=next_url,
@@ -70,16 +127,18 @@ def index():
 
 
 @bp.route('/user/<username>')
+@conditional(user_version)
 def user(username):
     """User Profile view function"""
-    user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    user = User.by_username(username) or abort(404)
+    posts = keyset_paginate(
+        user.posts.options(author_loader(Post)), (Post.timestamp, Post.id),
+        current_app.config['POSTS_PER_PAGE'],
+        before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.user', username=user.username,
+                       before=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.user', username=user.username,
+                       after=posts.prev_cursor) if posts.has_prev else None
     form = EmptyForm()
     return render_template('user.html', user=user, posts=posts.items,
                            form=form, title='Profile', next_url=next_url,
@@ -89,10 +148,22 @@ def user(username):
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    """User Popup view function"""
-    user = User.query.filter_by(username=username).first_or_404()
-    form = EmptyForm()
-    return render_template('user_template.html', user=user, form=form)
+    """User Popup view function. The browsers keep the popup for
+    USER_POPUP_MAX_AGE seconds, and then ask again with its entity tag."""
+    user = User.by_username(username) or abort(404)
+    # The popup changes with the user shown and with the users followed by
+    # the current user, whose changes both replace their version tokens
+    etag = current_app.fragment_cache.etag(user, current_user)
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        form = EmptyForm()
+        response = make_response(render_template('user_template.html',
+                                                 user=user, form=form))
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['USER_POPUP_MAX_AGE']
+    return response
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -105,7 +176,7 @@ def edit_profile():
         current_user.about_me = form.about_me.data
         db.session.commit()
         flash(_('Your changes have been saved'))
-        return redirect(url_for('edit_profile'))
+        return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
@@ -119,7 +190,7 @@ def follow(username):
     """View function for following users"""
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.by_username(username)
         if user is None:
             flash(_('User %(username)s not found', username=username))
             return redirect(url_for('main.index'))
@@ -140,7 +211,7 @@ def unfollow(username):
     """View function for unfollowing users"""
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.by_username(username)
         if user is None:
             flash(_('User %(username)s not found', username=username))
             return redirect(url_for('main.index'))
@@ -157,16 +228,23 @@ def unfollow(username):
 
 @bp.route('/explore')
 @login_required
+@conditional(explore_version)
 def explore():
     """View function to show posts from all users. It allows users to see
     posts from non-followed with the possibility of following new users,
-    thereby."""
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) \
+    thereby. The newest pages are served from the recent posts buffer,
+    the older ones from the database."""
+    before, after = request.args.get('before'), request.args.get('after')
+    per_page = current_app.config['POSTS_PER_PAGE']
+    posts = current_app.recent_posts.page(per_page, before=before,
+                                          after=after)
+    if posts is None:
+        posts = keyset_paginate(
+            Post.query.options(author_loader(Post)),
+            (Post.timestamp, Post.id), per_page, before=before, after=after)
+    next_url = url_for('main.explore', before=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
+    prev_url = url_for('main.explore', after=posts.prev_cursor) \
         if posts.has_prev else None
     return render_template('index.html', title=_("Explore"), posts=posts.items,
                            next_url=next_url, prev_url=prev_url)
@@ -181,7 +259,34 @@ def translate_text():
     translation string included in it.
     """
     return jsonify({'text': translate(request.form['text'],
-                                      request.form['dest_language'])})
+                                      request.form['dest_language'],
+                                      request.form.get('source_language'))})
+
+
+@bp.route('/translate/posts', methods=['POST'])
+@login_required
+def translate_posts():
+    """
+    Function used to respond to an Async http POST request sent to the server
+    to translate many posts at once, such as all the posts of a page. The
+    request holds the list of post ids and the destination language, and the
+    server responds with the translations by post id.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    ids = data.get('posts', [])
+    dest_language = data.get('dest_language') or str(get_locale())
+    if not isinstance(ids, list) or not isinstance(dest_language, str) or \
+            not all(isinstance(id, int) and not isinstance(id, bool) or
+                    isinstance(id, str) and id.isdigit() for id in ids):
+        abort(400)
+    ids = [int(id) for id in ids][:current_app.config['POSTS_PER_PAGE'] * 10]
+    posts = Post.query.filter(Post.id.in_(ids)).all() if ids else []
+    texts = translate_many([(post.body, post.language) for post in posts],
+                           dest_language)
+    return jsonify({'translations': {
+        str(post.id): text for post, text in zip(posts, texts)}})
 
 
 @bp.route('/search', methods=['GET'])
@@ -207,12 +312,13 @@ def send_message(recipient):
     """
     View function that allows a registered user to send message to another
     registered user within the Blogger app."""
-    user = User.query.filter_by(username=recipient).first_or_404()
+    user = User.by_username(recipient) or abort(404)
     form = MessageForm()
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
+        db.session.flush()
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         flash(_("Your message has been sent"))
@@ -222,20 +328,24 @@ def send_message(recipient):
 
 
 @bp.route('/messages')
+@fresh_user
 @login_required
 def messages():
     """View function that defines the logic for viewing messages for a 
-    registered user in the Blogger app."""
+    registered user in the Blogger app. It marks the messages as read, so it
+    needs a fresh current user."""
     current_user.last_message_read_time = datetime.utcnow()
+    current_user.unread_count = 0
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-            page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) \
+    messages = keyset_paginate(
+        current_user.messages_received.options(author_loader(Message)),
+        (Message.timestamp, Message.id),
+        current_app.config['POSTS_PER_PAGE'],
+        before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.messages', before=messages.next_cursor) \
         if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
+    prev_url = url_for('main.messages', after=messages.prev_cursor) \
         if messages.has_prev else None
     return render_template('messages.html', messages=messages.items,
                            next_url=next_url, prev_url=prev_url)
@@ -243,10 +353,31 @@ def messages():
 
 @bp.route('/notifications')
 @login_required
+@conditional(notifications_version)
 def notifications():
+    """View function that returns the notifications of the current user newer
+    than the 'since' timestamp. With the 'wait' argument (in seconds) and no
+    new notification, the request is held until a notification is committed
+    for the user or the wait time is over (long polling)."""
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter_by(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
+    wait = min(request.args.get('wait', 0.0, type=float),
+               current_app.config['NOTIFICATIONS_MAX_WAIT'])
+    if wait > 0:
+        # The request waits for the commits of the primary database, which a
+        # replica may not have yet
+        use_primary()
+    user_id = current_user.id
+    broker = current_app.notification_broker
+    event = broker.subscribe(user_id)
+    try:
+        notifications = Notification.since(user_id, since)
+        if not notifications and wait > 0:
+            # Give the database connection back while waiting
+            db.session.close()
+            if event.wait(wait):
+                notifications = Notification.since(user_id, since)
+    finally:
+        broker.unsubscribe(user_id, event)
     return jsonify([{
         'name': n.name,
         'data': n.get_data(),
@@ -7,14 +7,25 @@ different database tables for Blogger Flask App"""
 
 from time import time
 from datetime import datetime
+from functools import lru_cache
 from hashlib import md5
 import jwt
 import json
 from flask import current_app
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from elasticsearch import ElasticsearchException
 from blog import db, login
-from blog.search import add_to_index, remove_from_index, query_index
+from blog.clients import CircuitOpenError
+from blog.user_cache import needs_fresh_user
+from blog.search import (
+    bulk_index,
+    document,
+    fulltext_ddl,
+    invalidate_index,
+    query_index,
+    rebuild_index,
+)
 
 
 class SearchableMixin(object):
@@ -32,49 +43,136 @@ class SearchableMixin(object):
         when = []
         for i in range(len(ids)):
             when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
+        query = cls.query
+        if hasattr(cls, 'author'):
+            query = query.options(author_loader(cls))
+        return query.filter(cls.id.in_(ids)).order_by(
             db.case(when, value=cls.id)), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted),
-        }
-
-    @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+    def after_flush(cls, session, flush_context):
+        """Records the searchable objects changed by the flush, whose index
+        needs updating once the transaction is committed. When the
+        SEARCH_OUTBOX setting is enabled, the index updates are also written
+        to the search outbox within the same transaction."""
+        changes = session.info.setdefault('search_changes', {})
+        rows = []
+        for obj in list(session.new) + list(session.dirty):
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                changes[(obj.__tablename__, obj.id)] = obj
+                rows.append({'index': obj.__tablename__, 'object_id': obj.id,
+                             'action': 'index'})
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                changes[(obj.__tablename__, obj.id)] = None
+                rows.append({'index': obj.__tablename__, 'object_id': obj.id,
+                             'action': 'delete'})
+        if rows and current_app.config['SEARCH_OUTBOX']:
+            session.connection().execute(SearchOutbox.__table__.insert(), rows)
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def after_commit(cls, session):
+        changes = session.info.pop('search_changes', None)
+        if not changes:
+            return
+        for index in set(index for index, _ in changes):
+            invalidate_index(index)
+        if current_app.config['SEARCH_OUTBOX']:
+            return
+        actions = []
+        for (index, id), obj in changes.items():
+            if obj is None:
+                actions.append(('delete', index, id, None))
+            else:
+                actions.append(('index', index, id, document(obj)))
+        # The transaction is committed already, so the updates the search
+        # engine fails to take are queued in the outbox instead
+        try:
+            failed = bulk_index(actions)
+        except (CircuitOpenError, ElasticsearchException) as e:
+            current_app.logger.warning(
+                'Search index update failed, queued in the outbox: %s', e)
+            failed = set(changes)
+        if failed:
+            SearchOutbox.enqueue([(action, index, id)
+                                  for action, index, id, _ in actions
+                                  if (index, id) in failed])
 
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_changes', None)
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    @classmethod
+    def reindex(cls, batch_size=None, progress=None):
+        """Adds all the rows of the table to the search index. Unless the search
+        backend rebuilds the index by itself, the rows are streamed in batches
+        of batch_size rows (SEARCH_BULK_SIZE by default). The
+        optional progress function is called with the number of rows indexed
+        so far after each batch. Returns the number of rows indexed."""
+        if rebuild_index(cls.__tablename__, cls.__searchable__):
+            count = cls.query.count()
+            if progress:
+                progress(count)
+            return count
+        batch_size = batch_size or current_app.config['SEARCH_BULK_SIZE']
+        count = 0
+        batch = []
+        for obj in cls.query.order_by(cls.id).yield_per(batch_size):
+            batch.append(('index', cls.__tablename__, obj.id, document(obj)))
+            if len(batch) == batch_size:
+                bulk_index(batch)
+                count += len(batch)
+                batch = []
+                if progress:
+                    progress(count)
+        if batch:
+            bulk_index(batch)
+            count += len(batch)
+            if progress:
+                progress(count)
+        return count
+
+
+def author_loader(model):
+    """Returns the query option that loads the authors of posts or messages
+    together with them, so that rendering a page of them doesn't query each
+    author one at a time."""
+    return db.joinedload(model.author)
+
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+
+
+def email_digest(email):
+    """Returns the gravatar digest of an email address."""
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def gravatar_url(digest, size):
+    """Returns the gravatar avatar url for an email digest and a size."""
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
+        digest, size)
 
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    """Loads the logged in user of a request, through the user cache of the
+    application when it is enabled (see blog.user_cache)."""
+    if current_app.user_cache is None or needs_fresh_user():
+        return User.query.get(int(id))
+    return current_app.user_cache.load(int(id), User.query.get)
 
 
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer,
-                               db.ForeignKey('user.id')),
+                               db.ForeignKey('user.id'), primary_key=True),
                      db.Column('followed_id', db.Integer,
-                               db.ForeignKey('user.id'))
+                               db.ForeignKey('user.id'), primary_key=True),
+                     db.Index('ix_followers_followed_id_follower_id',
+                              'followed_id', 'follower_id')
                      )
 
 
@@ -83,6 +181,7 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    email_digest = db.Column(db.String(32))
     first_name = db.Column(db.String(64))
     last_name = db.Column(db.String(64))
     password_hash = db.Column(db.String(128))
@@ -101,6 +200,14 @@ class User(UserMixin, db.Model):
                                         foreign_keys='Message.recipient_id',
                                         backref='recipient', lazy='dynamic')
     last_message_read_time = db.Column(db.DateTime)
+    unread_count = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
+    follower_count = db.Column(db.Integer, nullable=False, default=0,
+                               server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0,
+                               server_default='0')
+    post_count = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0')
     notifications = db.relationship('Notification', backref='user',
                                     lazy='dynamic')
     
@@ -119,13 +226,46 @@ class User(UserMixin, db.Model):
         table."""
         return check_password_hash(self.password_hash, password)
 
+    @classmethod
+    def by_username(cls, username, recheck_missing=False):
+        """Returns the user with a username, or None. The username is resolved
+        to the user id through the user ids cache of the application, so that
+        finding a known user is a primary key get, answered by the session
+        without a query when the user is loaded already. The usernames found
+        missing are cached as well, unless recheck_missing is set, for the
+        checks that can't rely on an answer up to USER_IDS_CACHE_TTL seconds
+        old."""
+        return cls._by_identity('username', username, recheck_missing)
+
+    @classmethod
+    def by_email(cls, email, recheck_missing=False):
+        """Returns the user with an email address, or None (see
+        by_username)."""
+        return cls._by_identity('email', email, recheck_missing)
+
+    @classmethod
+    def _by_identity(cls, field, value, recheck_missing):
+        cache = current_app.user_ids
+        key = (field, value)
+        # The missing users are cached as id 0, which no user has
+        id = cache.get(key)
+        if id == 0 and not recheck_missing:
+            return None
+        if id:
+            user = cls.query.get(id)
+            # Another process may have renamed or deleted the user since
+            if user is not None and getattr(user, field) == value:
+                return user
+        user = cls.query.filter(getattr(cls, field) == value).first()
+        cache.set(key, user.id if user is not None else 0)
+        return user
+
     def avatar(self, size):
         """Grab the user avatar from gravtar web service. The size of the grabbed
         avatar depends on the size which is passed as argument to the avatar
         function"""
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+        return gravatar_url(self.email_digest or email_digest(self.email),
+                            size)
 
     def is_following(self, user):
         """Checks if a user is following another user or not. The function returns
@@ -137,20 +277,45 @@ class User(UserMixin, db.Model):
         """Make a user follow another user."""
         if not self.is_following(user):
             self.followed.append(user)
+            increment_counters(db.session, self.id, followed_count=1)
+            increment_counters(db.session, user.id, follower_count=1)
+            if current_app.config['HOME_TIMELINE']:
+                Timeline.add_author(self, user)
 
     def unfollow(self, user):
         """Make a user unfollow another user"""
         if self.is_following(user):
             self.followed.remove(user)
+            increment_counters(db.session, self.id, followed_count=-1)
+            increment_counters(db.session, user.id, follower_count=-1)
+            if current_app.config['HOME_TIMELINE']:
+                Timeline.remove_author(self, user)
 
     def followed_posts(self):
         """Returns the posts for followed users of a certain user and
-        his (her) own posts in a defined ordered manner."""
+        his (her) own posts in a defined ordered manner.
+
+        When the HOME_TIMELINE setting is enabled the posts are read from the
+        precomputed timeline table instead."""
+        timestamp, id = User.followed_posts_keys()
+        if current_app.config['HOME_TIMELINE']:
+            return Post.query.join(
+                Timeline, (Timeline.post_id == Post.id)).filter(
+                    Timeline.user_id == self.id).order_by(
+                        timestamp.desc(), id.desc())
         followed = Post.query.join(
             followers, (followers.c.followed_id == Post.user_id)).filter(
                 followers.c.follower_id == self.id)
         own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        return followed.union(own).order_by(timestamp.desc(), id.desc())
+
+    @staticmethod
+    def followed_posts_keys():
+        """Returns the (timestamp, id) columns that order the followed_posts
+        query, to be used for its keyset pagination."""
+        if current_app.config['HOME_TIMELINE']:
+            return Timeline.timestamp, Timeline.post_id
+        return Post.timestamp, Post.id
 
     def get_reset_password_token(self, expires_in=600):
         """Returns a password reset token to the calling function. The token
@@ -176,16 +341,98 @@ class User(UserMixin, db.Model):
 
     def new_messages(self):
         """Method that is used to show the number of unread messages for a
-        user."""
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        user. The number is kept in the unread_count field, which is
+        incremented whenever a message to the user is inserted and reset when
+        the user reads his (her) messages."""
+        return self.unread_count or 0
+
+    @staticmethod
+    def reconcile_unread_counts():
+        """Recomputes the unread_count field of all users from the messages
+        table with a single UPDATE statement. Returns the number of users."""
+        message = Message.__table__
+        user = User.__table__
+        unread = db.select([db.func.count(message.c.id)]).where(db.and_(
+            message.c.recipient_id == user.c.id,
+            message.c.timestamp > db.func.coalesce(
+                user.c.last_message_read_time, datetime(1900, 1, 1)))
+        ).as_scalar()
+        return db.session.execute(
+            user.update().values(unread_count=unread)).rowcount
+
+    @staticmethod
+    def check_counters(fix=False):
+        """Compares the follower_count, followed_count and post_count fields
+        of all users with the counts of the followers and post tables, taken
+        with one grouped query each. Returns a dictionary of the wrong
+        counters by user id, with the (stored, actual) pair of each counter.
+        With fix, the wrong counters are also corrected."""
+        actual = {}
+        for field, column in (('follower_count', followers.c.followed_id),
+                              ('followed_count', followers.c.follower_id),
+                              ('post_count', Post.user_id)):
+            actual[field] = dict(db.session.query(
+                column, db.func.count()).group_by(column))
+        wrong = {}
+        for row in db.session.query(User.id, User.follower_count,
+                                    User.followed_count, User.post_count):
+            for field in actual:
+                stored = getattr(row, field)
+                count = actual[field].get(row.id, 0)
+                if stored != count:
+                    wrong.setdefault(row.id, {})[field] = (stored, count)
+        if fix and wrong:
+            # The counts are taken again by the UPDATE itself, so that the
+            # changes made since the check aren't lost
+            user = User.__table__
+            post = Post.__table__
+            db.session.execute(user.update().where(
+                user.c.id.in_(list(wrong))).values(
+                    follower_count=db.select([db.func.count()]).where(
+                        followers.c.followed_id == user.c.id).as_scalar(),
+                    followed_count=db.select([db.func.count()]).where(
+                        followers.c.follower_id == user.c.id).as_scalar(),
+                    post_count=db.select([db.func.count()]).where(
+                        post.c.user_id == user.c.id).as_scalar()))
+            db.session.expire_all()
+        return wrong
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        """Replaces the notification of the given name of a user.
+
+        The notification is buffered in the session and written when the
+        session is committed, so that several notifications of the same name
+        for a user within a transaction end up as a single write. The requests
+        waiting for the notifications of the user are woken up after the
+        commit."""
+        pending = db.session.info.setdefault('notifications', {})
+        pending[(self.id, name)] = {'user_id': self.id, 'name': name,
+                                    'payload_json': json.dumps(data),
+                                    'timestamp': time()}
+
+
+@db.event.listens_for(User.email, 'set')
+def update_email_digest(target, value, oldvalue, initiator):
+    """Keeps the stored gravatar digest in sync with the user email."""
+    target.email_digest = email_digest(value) if value else None
+
+
+def publish_notifications(session):
+    """Wakes up the requests waiting for the notifications committed by the
+    session."""
+    user_ids = session.info.pop('notified_users', None)
+    if user_ids:
+        current_app.notification_broker.publish(user_ids)
+
+
+def discard_notifications(session):
+    """Forgets the notifications of a session that has been rolled back."""
+    session.info.pop('notifications', None)
+    session.info.pop('notified_users', None)
+
+
+db.event.listen(db.session, 'after_commit', publish_notifications)
+db.event.listen(db.session, 'after_rollback', discard_notifications)
 
 
 class Post(SearchableMixin, db.Model):
@@ -194,13 +441,139 @@ class Post(SearchableMixin, db.Model):
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # None until the language is detected, by a background worker, and an
+    # empty string when it couldn't be detected
     language = db.Column(db.String(5))
     __searchable__ = ['body']
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
     def __repr__(self):
         """Defines how new post instance is represented for debugging"""
         return '<Post {}>'.format(self.body)
 
+    def fan_out(self):
+        """Pushes the post into the home timeline of its author and of every
+        follower of its author. The post needs to be flushed first so that it
+        has an id."""
+        if current_app.config['HOME_TIMELINE']:
+            Timeline.add_post(self)
+
+
+def record_new_posts(session, flush_context):
+    """Records that the flush inserted posts whose language is still to be
+    detected."""
+    if any(isinstance(obj, Post) and obj.language is None
+           for obj in session.new):
+        session.info['new_posts'] = True
+
+
+def wake_language_worker(session):
+    """Wakes up the language detection worker after new posts have been
+    committed."""
+    worker = getattr(current_app, 'language_worker', None)
+    if session.info.pop('new_posts', False) and worker is not None:
+        worker.wake()
+
+
+def discard_new_posts(session):
+    """Forgets the new posts of a session that has been rolled back."""
+    session.info.pop('new_posts', None)
+
+
+def count_posts(session, flush_context):
+    """Updates in SQL the post_count field of the authors of the posts
+    inserted or deleted by a flush."""
+    counts = {}
+    for obj in session.new:
+        if isinstance(obj, Post):
+            counts[obj.user_id] = counts.get(obj.user_id, 0) + 1
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            counts[obj.user_id] = counts.get(obj.user_id, 0) - 1
+    for user_id, count in counts.items():
+        if user_id is not None and count:
+            increment_counters(session, user_id, post_count=count)
+
+
+db.event.listen(db.session, 'after_flush', count_posts)
+db.event.listen(db.session, 'after_flush', record_new_posts)
+db.event.listen(db.session, 'after_commit', wake_language_worker)
+db.event.listen(db.session, 'after_rollback', discard_new_posts)
+
+
+class Timeline(db.Model):
+    """Defines the precomputed home timeline of every user. Each row links a
+    user to a post that shows on his (her) home page, so the home page is read
+    with a single indexed range scan instead of a join and a union."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'),
+                        primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    timestamp = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp',
+                 'post_id'),
+    )
+
+    def __repr__(self):
+        """Defines how new timeline instance is represented for debugging"""
+        return '<Timeline {} {}>'.format(self.user_id, self.post_id)
+
+    @staticmethod
+    def add_post(post):
+        """Adds a new post to the timelines of its author and followers."""
+        table = Timeline.__table__
+        db.session.execute(table.insert().values(
+            user_id=post.user_id, post_id=post.id, author_id=post.user_id,
+            timestamp=post.timestamp))
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            db.select([followers.c.follower_id,
+                       db.literal(post.id),
+                       db.literal(post.user_id),
+                       db.literal(post.timestamp, db.DateTime)]).where(
+                           followers.c.followed_id == post.user_id)))
+
+    @staticmethod
+    def add_author(user, author):
+        """Adds all the posts of an author to the timeline of a user."""
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            db.select([db.literal(user.id), Post.id, Post.user_id,
+                       Post.timestamp]).where(Post.user_id == author.id)))
+
+    @staticmethod
+    def remove_author(user, author):
+        """Removes all the posts of an author from the timeline of a user."""
+        db.session.execute(Timeline.__table__.delete().where(db.and_(
+            Timeline.user_id == user.id, Timeline.author_id == author.id)))
+
+    @staticmethod
+    def rebuild():
+        """Rebuilds the timelines of all the users from the posts and
+        followers tables and returns the number of timeline rows."""
+        table = Timeline.__table__
+        columns = ['user_id', 'post_id', 'author_id', 'timestamp']
+        db.session.execute(table.delete())
+        db.session.execute(table.insert().from_select(
+            columns, db.select([Post.user_id, Post.id,
+                                Post.user_id.label('author_id'),
+                                Post.timestamp])))
+        db.session.execute(table.insert().from_select(
+            columns, db.select([followers.c.follower_id, Post.id,
+                                Post.user_id, Post.timestamp]).where(
+                                    followers.c.followed_id == Post.user_id)))
+        return db.session.query(db.func.count(Timeline.post_id)).scalar()
+
+
+# Create the full-text index used by the database search backend along with
+# the post table
+for event, ddl in fulltext_ddl(Post.__tablename__, Post.__searchable__):
+    db.event.listen(Post.__table__, event, ddl)
+
 
 class Message(db.Model):
     """Defines the various fields and methods for the Message database table"""
@@ -209,12 +582,180 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (
+        db.Index('ix_message_recipient_id_timestamp', 'recipient_id',
+                 'timestamp'),
+    )
 
     def __repr__(self):
         """Defines how new message instance is represented for debugging"""
         return '<Message {}>'.format(self.body)
 
 
+def record_changed_rows(session, table, ids):
+    """Records rows changed in the transaction of a session without going
+    through its objects, such as with bulk UPDATE statements, so that their
+    cached copies are invalidated once the transaction is committed."""
+    session.info.setdefault('changed_rows', set()).update(
+        (table, id) for id in ids)
+
+
+def record_changed_objects(session, flush_context):
+    """Records the rows of the users and posts changed by a flush, whose
+    cached copies are invalidated once the transaction is committed."""
+    changed = session.info.setdefault('changed_rows', set())
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(obj, (User, Post)):
+            changed.add((obj.__tablename__, obj.id))
+
+
+def invalidate_changed_rows(session):
+    """Invalidates the rendered fragments of the rows committed by the
+    session, and the snapshots of the recent posts and cached users among
+    them."""
+    changed = session.info.pop('changed_rows', None)
+    if changed:
+        current_app.fragment_cache.invalidate(changed)
+        recent_posts = getattr(current_app, 'recent_posts', None)
+        if recent_posts is not None:
+            recent_posts.invalidate(
+                post_ids=[id for table, id in changed if table == 'post'])
+        user_cache = getattr(current_app, 'user_cache', None)
+        if user_cache is not None:
+            user_cache.invalidate(
+                [id for table, id in changed if table == 'user'])
+
+
+def discard_changed_rows(session):
+    """Forgets the changed rows of a session that has been rolled back."""
+    session.info.pop('changed_rows', None)
+
+
+db.event.listen(db.session, 'after_flush', record_changed_objects)
+db.event.listen(db.session, 'after_commit', invalidate_changed_rows)
+db.event.listen(db.session, 'after_rollback', discard_changed_rows)
+
+
+def record_recent_posts(session, flush_context):
+    """Records the snapshots of the posts inserted by a flush, which are
+    pushed to the recent posts buffer once the transaction is committed, and
+    the users whose name or avatar changed."""
+    recent_posts = getattr(current_app, 'recent_posts', None)
+    if recent_posts is None:
+        return
+    info = session.info.setdefault('recent_posts',
+                                   {'posts': [], 'authors': set()})
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.author is not None:
+            info['posts'].append(recent_posts.snapshot(obj))
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            attrs = db.inspect(obj).attrs
+            if attrs.username.history.has_changes() or \
+               attrs.email.history.has_changes():
+                info['authors'].add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            info['authors'].add(obj.id)
+
+
+def push_recent_posts(session):
+    """Pushes the posts committed by the session to the recent posts buffer,
+    which is invalidated when the authors of its posts changed."""
+    info = session.info.pop('recent_posts', None)
+    if info:
+        current_app.recent_posts.invalidate(author_ids=info['authors'])
+        current_app.recent_posts.push(info['posts'])
+
+
+def discard_recent_posts(session):
+    """Forgets the recent posts of a session that has been rolled back."""
+    session.info.pop('recent_posts', None)
+
+
+db.event.listen(db.session, 'after_flush', record_recent_posts)
+db.event.listen(db.session, 'after_commit', push_recent_posts)
+db.event.listen(db.session, 'after_rollback', discard_recent_posts)
+
+
+def record_user_identities(session, flush_context):
+    """Records the usernames and emails of the users inserted, changed or
+    deleted by a flush, whose cached user ids are dropped once the
+    transaction is committed."""
+    identities = session.info.setdefault('user_identities', set())
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(obj, User):
+            attrs = db.inspect(obj).attrs
+            for field in ('username', 'email'):
+                history = getattr(attrs, field).history
+                if obj in session.dirty and not history.has_changes():
+                    continue
+                identities.update((field, value) for value in history.sum())
+
+
+def forget_user_identities(session):
+    """Drops the cached user ids of the usernames and emails committed by the
+    session, so that new, renamed and deleted users are looked up again."""
+    for key in session.info.pop('user_identities', ()):
+        current_app.user_ids.delete(key)
+
+
+def discard_user_identities(session):
+    """Forgets the user identities of a session that has been rolled back."""
+    session.info.pop('user_identities', None)
+
+
+db.event.listen(db.session, 'after_flush', record_user_identities)
+db.event.listen(db.session, 'after_commit', forget_user_identities)
+db.event.listen(db.session, 'after_rollback', discard_user_identities)
+
+
+def increment_counters(session, user_id, **increments):
+    """Increments in SQL, within the transaction of the session, counter
+    fields of a user given as keyword arguments, so that concurrent
+    increments can't get lost. The fields are expired on the user instance
+    of the session, if any, to be read again, and the rendered fragments of
+    the user are invalidated after commit."""
+    user = User.__table__
+    session.connection().execute(user.update().where(
+        user.c.id == user_id).values(**{
+            field: user.c[field] + increment
+            for field, increment in increments.items()}))
+    instance = session.identity_map.get(
+        db.inspect(User).identity_key_from_primary_key([user_id]))
+    if instance is not None:
+        session.expire(instance, list(increments))
+    record_changed_rows(session, 'user', [user_id])
+
+
+def check_user_counters():
+    """Corrects and logs the wrong counters of the users (see
+    User.check_counters). It is the job of the periodic counters checker, and
+    returns the number of users corrected."""
+    wrong = User.check_counters(fix=True)
+    if wrong:
+        current_app.logger.warning('Corrected the counters of %d users: %s',
+                                   len(wrong), wrong)
+        db.session.commit()
+    return len(wrong)
+
+
+def count_unread_messages(session, flush_context):
+    """Increments in SQL the unread_count field of the recipients of the
+    messages inserted by a flush."""
+    counts = {}
+    for obj in session.new:
+        if isinstance(obj, Message):
+            counts[obj.recipient_id] = counts.get(obj.recipient_id, 0) + 1
+    for recipient_id, count in counts.items():
+        increment_counters(session, recipient_id, unread_count=count)
+
+
+db.event.listen(db.session, 'after_flush', count_unread_messages)
+
+
 class Notification(db.Model):
     """Defines the various fields and methods for the Notification db table."""
     
@@ -223,6 +764,167 @@ class Notification(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
+    __table_args__ = (
+        db.Index('ix_notification_user_id_name', 'user_id', 'name',
+                 unique=True),
+    )
 
     def get_data(self):
         return json.loads(str(self.payload_json))
+
+    @staticmethod
+    def since(user_id, timestamp):
+        """Returns the notifications of a user newer than a timestamp, oldest
+        first."""
+        return Notification.query.filter(
+            Notification.user_id == user_id,
+            Notification.timestamp > timestamp).order_by(
+                Notification.timestamp.asc()).all()
+
+
+def upsert_notifications(connection, rows):
+    """Inserts notification rows, replacing the existing notifications with
+    the same user and name, with a single statement on SQLite and PostgreSQL.
+    Other databases get a delete followed by an insert."""
+    table = Notification.__table__
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'name'],
+            set_={'payload_json': statement.excluded.payload_json,
+                  'timestamp': statement.excluded.timestamp}), rows)
+    elif dialect == 'sqlite':
+        connection.execute(db.text(
+            'INSERT INTO notification (user_id, name, payload_json, timestamp) '
+            'VALUES (:user_id, :name, :payload_json, :timestamp) '
+            'ON CONFLICT (user_id, name) DO UPDATE SET '
+            'payload_json = excluded.payload_json, '
+            'timestamp = excluded.timestamp'), rows)
+    else:
+        for row in rows:
+            connection.execute(table.delete().where(db.and_(
+                table.c.user_id == row['user_id'],
+                table.c.name == row['name'])))
+        connection.execute(table.insert(), rows)
+
+
+def write_notifications(session):
+    """Writes the notifications buffered by User.add_notification before the
+    session is committed."""
+    pending = session.info.pop('notifications', None)
+    if not pending:
+        return
+    upsert_notifications(session.connection(), list(pending.values()))
+    session.info.setdefault('notified_users', set()).update(
+        user_id for user_id, _ in pending)
+
+
+db.event.listen(db.session, 'before_commit', write_notifications)
+
+
+class SearchOutbox(db.Model):
+    """Defines the search index updates that are waiting to be sent to the
+    search engine. The rows are written in the same transaction as the changes
+    of the searchable models and sent later in bulk by a background worker,
+    so that the search engine is kept out of the request path."""
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64))
+    object_id = db.Column(db.Integer)
+    action = db.Column(db.String(8))
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.Float, index=True, default=time)
+
+    def __repr__(self):
+        """Defines how new outbox instance is represented for debugging"""
+        return '<SearchOutbox {} {}/{}>'.format(self.action, self.index,
+                                                self.object_id)
+
+    @staticmethod
+    def enqueue(updates):
+        """Queues (action, index, id) index updates outside of the session
+        transaction, for the updates that failed after it was committed. They
+        are sent by the outbox worker, which runs along with Elasticsearch
+        (see SEARCH_OUTBOX in the configuration), or by the 'flask search
+        drain' command."""
+        with db.engine.begin() as connection:
+            connection.execute(SearchOutbox.__table__.insert(), [
+                {'index': index, 'object_id': id, 'action': action,
+                 'attempts': 0, 'next_attempt': time()}
+                for action, index, id in updates])
+
+    @staticmethod
+    def drain(batch_size=None):
+        """Sends a batch of due index updates to the search engine with one
+        bulk request. Updates that fail are retried later with an exponential
+        backoff. Returns the number of outbox rows processed."""
+        config = current_app.config
+        batch_size = batch_size or config['SEARCH_BULK_SIZE']
+        now = time()
+        entries = SearchOutbox.query.filter(
+            SearchOutbox.next_attempt <= now).order_by(
+                SearchOutbox.id).limit(batch_size).all()
+        if not entries:
+            return 0
+
+        # Only the latest update of every document needs to be sent
+        latest = {}
+        for entry in entries:
+            latest[(entry.index, entry.object_id)] = entry.action
+        models = {model.__tablename__: model
+                  for model in SearchableMixin.__subclasses__()}
+        actions = []
+        for index in set(index for index, _ in latest):
+            model = models[index]
+            ids = [id for (i, id), action in latest.items()
+                   if i == index and action == 'index']
+            found = {obj.id: obj for obj in model.query.filter(
+                model.id.in_(ids))} if ids else {}
+            for (i, id), action in latest.items():
+                if i != index:
+                    continue
+                if action == 'index' and id in found:
+                    actions.append(('index', index, id, document(found[id])))
+                else:
+                    actions.append(('delete', index, id, None))
+        try:
+            failed = bulk_index(actions)
+        except Exception as e:
+            # Any error of the search engine client makes the whole batch
+            # to be retried
+            current_app.logger.warning('Search index update failed: %s', e)
+            failed = set(latest)
+
+        done = []
+        for entry in entries:
+            if (entry.index, entry.object_id) in failed:
+                entry.attempts += 1
+                entry.next_attempt = now + min(
+                    config['SEARCH_OUTBOX_MAX_DELAY'],
+                    config['SEARCH_OUTBOX_RETRY_DELAY'] *
+                    2 ** (entry.attempts - 1))
+            else:
+                done.append(entry.id)
+        for index in set(index for index, _ in latest):
+            invalidate_index(index)
+        if done:
+            SearchOutbox.query.filter(SearchOutbox.id.in_(done)).delete(
+                synchronize_session=False)
+        db.session.commit()
+        return len(entries)
+
+
+class Translation(db.Model):
+    """Defines the translations of texts already returned by the translation
+    service, so that the same text is never sent twice for the same
+    languages."""
+    text_hash = db.Column(db.String(40), primary_key=True)
+    source_language = db.Column(db.String(5), primary_key=True)
+    dest_language = db.Column(db.String(5), primary_key=True)
+    text = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        """Defines how new translation instance is represented for debugging"""
+        return '<Translation {} {}>'.format(self.text_hash, self.dest_language)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Keyset (cursor) pagination module for Blogger App feeds.
+
+Feeds are ordered by a (timestamp, id) pair of columns, newest first. Instead
+of skipping rows with an OFFSET, every page is fetched with a range condition
+on those columns starting from an opaque cursor, so the cost of a page does not
+depend on how deep it is and rows don't shift when new posts arrive."""
+
+import base64
+import binascii
+from datetime import datetime
+from blog import db
+
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(timestamp, id):
+    """Returns an opaque url-safe cursor string for a (timestamp, id) pair."""
+    raw = '{}_{}'.format(timestamp.strftime(CURSOR_FORMAT), id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Returns the (timestamp, id) pair of a cursor string created by
+    encode_cursor or None if the cursor is missing or invalid."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, id = raw.rsplit('_', 1)
+        return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+    except (ValueError, binascii.Error, UnicodeError):
+        return None
+
+
+def keyset_filter(keys, cursor, older=True):
+    """Returns the filter condition that selects the rows that are older (or
+    newer) than the cursor for the given (timestamp, id) key columns.
+
+    The redundant bound on the timestamp alone lets the database seek into
+    the timestamp index instead of scanning it from the start."""
+    timestamp, id = keys
+    if older:
+        return db.and_(timestamp <= cursor[0], db.or_(
+            timestamp < cursor[0], id < cursor[1]))
+    return db.and_(timestamp >= cursor[0], db.or_(
+        timestamp > cursor[0], id > cursor[1]))
+
+
+class KeysetPage(object):
+    """A page of items fetched by keyset_paginate along with the cursors of
+    its first and last items. The items need timestamp and id attributes.
+
+    A page fetched with a 'before' cursor past the oldest item is empty; its
+    link to the newer page starts from that cursor (the before argument)."""
+
+    def __init__(self, items, has_next, has_prev, before=None):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.before = before
+
+    @property
+    def next_cursor(self):
+        """Cursor to pass as the 'before' argument for the older page."""
+        if not self.has_next:
+            return None
+        return encode_cursor(self.items[-1].timestamp, self.items[-1].id)
+
+    @property
+    def prev_cursor(self):
+        """Cursor to pass as the 'after' argument for the newer page."""
+        if not self.has_prev:
+            return None
+        if not self.items:
+            return encode_cursor(*self.before)
+        return encode_cursor(self.items[0].timestamp, self.items[0].id)
+
+
+def keyset_paginate(query, keys, per_page, before=None, after=None):
+    """Returns a KeysetPage of at most per_page items of the query, newest
+    first.
+
+    Keyword Arguments:
+    query -- The query to paginate; any existing ordering is replaced
+    keys -- The (timestamp, id) columns used for the ordering and filtering
+    per_page -- The number of items per page
+    before -- Cursor string; only items older than it are returned
+    after -- Cursor string; only items newer than it are returned
+    """
+    timestamp, id = keys
+    before, after = decode_cursor(before), decode_cursor(after)
+    query = query.order_by(None)
+    if after is not None:
+        items = query.filter(keyset_filter(keys, after, older=False)).order_by(
+            timestamp.asc(), id.asc()).limit(per_page + 1).all()
+        has_prev = len(items) > per_page
+        items = items[:per_page][::-1]
+        return KeysetPage(items, bool(items), has_prev)
+    if before is not None:
+        query = query.filter(keyset_filter(keys, before))
+    items = query.order_by(timestamp.desc(), id.desc()).limit(
+        per_page + 1).all()
+    return KeysetPage(items[:per_page], len(items) > per_page,
+                      before is not None, before)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""In-process publish/subscribe module for Blogger App. It lets the requests
+waiting for the notifications of a user wake up as soon as new notifications
+are committed, instead of polling the database."""
+
+from threading import Event, Lock
+
+
+class NotificationBroker(object):
+    """Wakes up the subscribers of a user when notifications are published
+    for him (her).
+
+    The broker only knows about the notifications committed by the same
+    process, so subscribers should always wait with a timeout and check the
+    database again once it has passed."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._subscribers = {}
+
+    def subscribe(self, user_id):
+        """Returns an event that is set on the next publish for the user.
+        It must be given back to unsubscribe once the wait is over."""
+        event = Event()
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, user_id, event):
+        """Stops an event returned by subscribe from being notified."""
+        with self._lock:
+            events = self._subscribers.get(user_id)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self._subscribers[user_id]
+
+    def publish(self, user_ids):
+        """Wakes up all the subscribers of the given users."""
+        with self._lock:
+            events = [event for user_id in user_ids
+                      for event in self._subscribers.get(user_id, ())]
+        for event in events:
+            event.set()
+
+    def subscriber_count(self):
+        """Returns the number of subscriptions waiting."""
+        with self._lock:
+            return sum(len(events) for events in self._subscribers.values())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Recent posts module for Blogger App.
+
+Most of the explore page requests are for its first few pages, which show
+the newest posts of all. The process keeps a bounded buffer of snapshots of
+the newest posts, with the fields of their authors the posts are rendered
+with, and serves the pages that lie within the buffer without querying the
+database. The posts committed by the process are pushed to the buffer by the
+session events of blog.models, and the buffer is loaded again from the
+database when posts in it or their authors change. The posts committed by
+other processes only show up when the buffer is loaded again, at most ttl
+seconds after the last load."""
+
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from time import monotonic
+from blog.models import Post, author_loader, email_digest, gravatar_url
+from blog.pagination import KeysetPage, decode_cursor
+
+
+class AuthorSnapshot(object):
+    """Read-only copy of the fields of a user the posts are rendered with."""
+    __tablename__ = 'user'
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email_digest = user.email_digest or email_digest(user.email)
+
+    def avatar(self, size):
+        """Returns the gravatar avatar url of the user for a size."""
+        return gravatar_url(self.email_digest, size)
+
+
+class PostSnapshot(object):
+    """Read-only copy of a post and its author, detached from any database
+    session, which renders like a Post."""
+    __tablename__ = 'post'
+
+    def __init__(self, post):
+        self.id = post.id
+        self.body = post.body
+        self.timestamp = post.timestamp
+        self.language = post.language
+        self.user_id = post.user_id
+        self.author = AuthorSnapshot(post.author)
+
+    @property
+    def key(self):
+        """The (timestamp, id) keys the posts are ordered by."""
+        return self.timestamp, self.id
+
+
+class RecentPosts(object):
+    """Thread-safe buffer of the snapshots of the newest maxsize posts.
+
+    The buffer always holds the newest posts known to the process without
+    gaps, so that any page of posts newer than its oldest one can be served
+    from it. It is loaded lazily, and loaded again when it was invalidated or
+    ttl seconds after the last load. A maxsize of 0 disables the buffer."""
+
+    def __init__(self, maxsize=500, ttl=10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self._posts = []
+        self._keys = []
+        self._complete = False
+        self._loaded_at = None
+        self._generation = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._posts)
+
+    @staticmethod
+    def snapshot(post):
+        """Returns the snapshot of a post whose author is loaded."""
+        return PostSnapshot(post)
+
+    def load(self):
+        """Loads the newest posts from the database, in one query."""
+        with self._lock:
+            generation = self._generation
+        posts = Post.query.options(author_loader(Post)).order_by(
+            Post.timestamp.desc(), Post.id.desc()).limit(self.maxsize).all()
+        snapshots = [PostSnapshot(post) for post in reversed(posts)]
+        with self._lock:
+            self._posts = snapshots
+            self._keys = [post.key for post in snapshots]
+            self._complete = len(snapshots) < self.maxsize
+            # Posts pushed or invalidated during the query may be missing
+            # from it, so the buffer is only trusted until the next request
+            self._loaded_at = monotonic() \
+                if generation == self._generation else None
+            self.loads += 1
+
+    def push(self, snapshots):
+        """Adds the snapshots of new posts, dropping the oldest posts when
+        the buffer is full. Nothing is done before the buffer is loaded."""
+        with self._lock:
+            self._generation += 1
+            if self._loaded_at is None:
+                return
+            for post in snapshots:
+                index = bisect_left(self._keys, post.key)
+                self._posts.insert(index, post)
+                self._keys.insert(index, post.key)
+            if len(self._posts) > self.maxsize:
+                del self._posts[:-self.maxsize]
+                del self._keys[:-self.maxsize]
+                self._complete = False
+
+    def invalidate(self, post_ids=(), author_ids=()):
+        """Makes the buffer load again from the database when it holds any of
+        the changed posts or posts of the changed authors."""
+        post_ids, author_ids = set(post_ids), set(author_ids)
+        if not post_ids and not author_ids:
+            return
+        with self._lock:
+            self._generation += 1
+            if any(post.id in post_ids or post.user_id in author_ids
+                   for post in self._posts):
+                self._loaded_at = None
+
+    def page(self, per_page, before=None, after=None):
+        """Returns the KeysetPage of the newest posts that keyset_paginate
+        would return for the same arguments (see blog.pagination), or None
+        when the page doesn't lie within the buffer and has to be queried
+        from the database."""
+        if self.maxsize <= 0:
+            return None
+        if self._loaded_at is None or \
+           monotonic() - self._loaded_at >= self.ttl:
+            self.load()
+        before, after = decode_cursor(before), decode_cursor(after)
+        with self._lock:
+            if after is not None:
+                if not self._complete and \
+                   (not self._keys or after < self._keys[0]):
+                    self.misses += 1
+                    return None
+                start = bisect_right(self._keys, after)
+                items = self._posts[start:start + per_page + 1]
+                has_prev = len(items) > per_page
+                items = items[:per_page][::-1]
+                self.hits += 1
+                return KeysetPage(items, bool(items), has_prev)
+            end = bisect_left(self._keys, before) \
+                if before is not None else len(self._keys)
+            if end <= per_page and not self._complete:
+                self.misses += 1
+                return None
+            items = self._posts[max(end - per_page - 1, 0):end][::-1]
+            self.hits += 1
+            return KeysetPage(items[:per_page], len(items) > per_page,
+                              before is not None, before)
+
+    def stats(self):
+        """Returns the size of the buffer and its counters: the pages served
+        from it, the pages left to the database and the loads."""
+        return {'size': len(self._posts), 'hits': self.hits,
+                'misses': self.misses, 'loads': self.loads}
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Read replicas module for Blogger App.
+
+The reads of the GET requests go to one of the read replicas listed in the
+DATABASE_REPLICA_URLS setting, chosen at random for every request. Everything
+else uses the primary database: the writes, the requests other than GET, the
+views decorated with blog.user_cache.fresh_user, the requests that call
+use_primary, the background workers and the command-line tools.
+
+The replicas may lag behind the primary database, so a client that has
+written something keeps reading from the primary database for
+DATABASE_REPLICA_STICKINESS seconds, and reads its own writes. The time of
+the last write is kept in the session cookie of the client."""
+
+import random
+from time import time
+from flask import has_request_context, request, session as client_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+
+REPLICA_BIND = 'replica{}'
+
+
+def replica_binds(urls):
+    """Returns the Flask-SQLAlchemy binds of the replicas with the given
+    URLs."""
+    return {REPLICA_BIND.format(i): url for i, url in enumerate(urls)}
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from a replica during the GET requests (see the
+    module documentation)."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        """Returns the engine of a replica for the reads that may use one, or
+        the engine of the primary database."""
+        replicas = self.app.config['DATABASE_REPLICA_URLS']
+        if replicas and not self._flushing and self._may_use_replica():
+            index = request.environ.setdefault(
+                'blog.replica', random.randrange(len(replicas)))
+            return self.db.get_engine(self.app,
+                                      bind=REPLICA_BIND.format(index))
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _may_use_replica(self):
+        # blog.user_cache needs the db object this module is imported for
+        from blog.user_cache import needs_fresh_user
+        if not has_request_context() or \
+           request.environ.get('blog.primary') or needs_fresh_user():
+            return False
+        stickiness = self.app.config['DATABASE_REPLICA_STICKINESS']
+        return client_session.get('db_write', 0) + stickiness <= time()
+
+
+def use_primary():
+    """Sends the reads of the rest of the current request to the primary
+    database, for the requests that must see the latest commits, such as the
+    ones woken up by a commit."""
+    if has_request_context():
+        request.environ['blog.primary'] = True
+
+
+def record_write(session, flush_context):
+    """Records in the session cookie of the client the time it wrote to the
+    database, which keeps its reads on the primary database."""
+    if has_request_context() and session.app.config['DATABASE_REPLICA_URLS']:
+        client_session['db_write'] = time()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension whose sessions route the reads of the GET
+    requests to the read replicas."""
+
+    def create_session(self, options):
+        """Returns the factory of the routing sessions."""
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_flush', record_write)
+        return factory
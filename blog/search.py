@@ -1,9 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""Full Text search capability module for Blogger App"""
+"""Full Text search capability module for Blogger App.
 
+The functions of this module are the interface the models use for full-text
+search. They forward to the search backend chosen by the SEARCH_BACKEND
+setting:
+
+elasticsearch -- An Elasticsearch cluster (see the ELASTICSEARCH_URL setting)
+database -- The full-text search of the database itself, FTS5 on SQLite and
+tsvector with a GIN index on PostgreSQL. The full-text index is kept in sync
+by the database, so it needs no separate cluster.
+"""
+
+from elasticsearch import ElasticsearchException
 from flask import current_app
+from sqlalchemy import DDL, text
+from blog import db
+from blog.clients import CircuitOpenError
 
 
 def add_to_index(index, model):
@@ -14,12 +28,7 @@ def add_to_index(index, model):
     index -- The full text index for the text-search tool
     model -- The model that will be queried for any text string
     """
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    _backend().add(index, model.id, document(model))
 
 
 def remove_from_index(index, model):
@@ -28,20 +37,252 @@ def remove_from_index(index, model):
     index -- The full text index for the text-search tool
     model -- The model that will be queried for any text string
     """
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    _backend().remove(index, model.id)
+
+
+def bulk_index(actions):
+    """Sends many index and delete operations to the search engine at once.
+    Returns the set of (index, id) pairs of the operations that failed.
+    Keyword Arguments:
+    actions -- Iterable of (action, index, id, document) tuples where action
+    is either 'index' or 'delete' and document is the searchable document of
+    the model (see document function), or None for deletes
+    """
+    return _backend().bulk(actions)
+
+
+def rebuild_index(index, fields):
+    """Rebuilds a whole index from its table when the search backend can do
+    it by itself. Returns False when the documents need to be sent one batch
+    at a time with bulk_index instead."""
+    return _backend().rebuild(index, fields)
 
 
 def query_index(index, query, page, per_page):
     """Function to do a search within an index for a certain query string of
     text. The returning results depend on the provided page and the number of
-    results per page within the search."""
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    results per page within the search.
+
+    The results are cached in the application search cache, keyed by the
+    index, the normalized query, the page and the number of results per page,
+    until the index changes (see invalidate_index). No results are returned
+    while the search engine is unavailable."""
+    key = (index, ' '.join(query.lower().split()), page, per_page)
+    results = current_app.search_cache.get(key)
+    if results is None:
+        results = _backend().query(index, query, page, per_page)
+        if results is None:
+            # The search engine is unavailable, which isn't worth caching
+            return [], 0
+        current_app.search_cache.set(key, results)
+    return results
+
+
+def invalidate_index(index):
+    """Drops the cached search results of an index after its documents have
+    changed."""
+    current_app.search_cache.delete_where(lambda key: key[0] == index)
+
+
+def document(model):
+    """Returns the document to index for a model with a __searchable__
+    attribute."""
+    payload = {}
+    for field in model.__searchable__:
+        payload[field] = getattr(model, field)
+    return payload
+
+
+def fulltext_ddl(table, fields):
+    """Returns the DDL statements that create and drop the database full-text
+    index of a table, as (event, DDL) pairs to listen for on the table. Each
+    statement only runs on the database dialect it is written for."""
+    columns = ', '.join(fields)
+    new = ', '.join('new.' + field for field in fields)
+    old = ', '.join('old.' + field for field in fields)
+    fts = table + '_fts'
+    sqlite = [
+        "CREATE VIRTUAL TABLE {fts} USING fts5({columns}, content='{table}', "
+        "content_rowid='id')",
+        "CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN "
+        "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+        "CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, {columns}) "
+        "VALUES ('delete', old.id, {old}); END",
+        "CREATE TRIGGER {fts}_update AFTER UPDATE ON {table} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, {columns}) "
+        "VALUES ('delete', old.id, {old}); "
+        "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+    ]
+    ddl = [('after_create', DDL(statement.format(
+        fts=fts, table=table, columns=columns, new=new, old=old)).execute_if(
+            dialect='sqlite')) for statement in sqlite]
+    ddl.append(('after_create', DDL(
+        'CREATE INDEX ix_{table}_fulltext ON {table} USING gin ({vector})'
+        .format(table=table, vector=_tsvector(fields))).execute_if(
+            dialect='postgresql')))
+    ddl.append(('before_drop', DDL(
+        'DROP TABLE IF EXISTS {}'.format(fts)).execute_if(dialect='sqlite')))
+    return ddl
+
+
+def _tsvector(fields):
+    """Returns the PostgreSQL tsvector expression of the searchable fields,
+    which has to be the same in the GIN index and in the queries."""
+    return "to_tsvector('simple', {})".format(' || \' \' || '.join(
+        "coalesce({}, '')".format(field) for field in fields))
+
+
+def _call(function, **kwargs):
+    """Calls a function of the Elasticsearch client through the circuit
+    breaker of the cluster."""
+    return current_app.circuit_breakers['elasticsearch'].call(function,
+                                                              **kwargs)
+
+
+def _backend():
+    """Returns the search backend chosen by the SEARCH_BACKEND setting."""
+    return _backends[current_app.config['SEARCH_BACKEND']]
+
+
+class ElasticsearchBackend(object):
+    """Search backend that uses the Elasticsearch client of the application.
+    It does nothing when Elasticsearch is not configured. All the requests go
+    through the Elasticsearch circuit breaker of the application, so they fail
+    fast with CircuitOpenError while the cluster is down."""
+
+    def add(self, index, id, payload):
+        if not current_app.elasticsearch:
+            return
+        _call(current_app.elasticsearch.index, index=index, id=id,
+              body=payload)
+
+    def remove(self, index, id):
+        if not current_app.elasticsearch:
+            return
+        _call(current_app.elasticsearch.delete, index=index, id=id)
+
+    def bulk(self, actions):
+        """Sends the operations with the Elasticsearch bulk API, in batches of
+        SEARCH_BULK_SIZE operations."""
+        if not current_app.elasticsearch:
+            return set()
+        batch_size = current_app.config['SEARCH_BULK_SIZE']
+        failed = set()
+        body = []
+        count = 0
+        for action, index, id, payload in actions:
+            body.append({action: {'_index': index, '_id': id}})
+            if action == 'index':
+                body.append(payload)
+            count += 1
+            if count % batch_size == 0:
+                failed |= self._send_bulk(body)
+                body = []
+        if body:
+            failed |= self._send_bulk(body)
+        return failed
+
+    def _send_bulk(self, body):
+        """Sends one bulk request, logs the operations that failed and
+        returns their (index, id) pairs."""
+        response = _call(current_app.elasticsearch.bulk, body=body)
+        failed = set()
+        if response.get('errors'):
+            for item in response['items']:
+                for action, result in item.items():
+                    if result.get('error'):
+                        current_app.logger.warning(
+                            'Search %s of %s/%s failed: %s', action,
+                            result.get('_index'), result.get('_id'),
+                            result['error'])
+                        failed.add((result.get('_index'), int(result['_id'])))
+        return failed
+
+    def rebuild(self, index, fields):
+        return False
+
+    def query(self, index, query, page, per_page):
+        """Returns the ids of the matching documents and their total number,
+        or None when the cluster can't be reached."""
+        if not current_app.elasticsearch:
+            return [], 0
+        try:
+            search = _call(
+                current_app.elasticsearch.search, index=index,
+                body={'query': {'multi_match': {'query': query,
+                                                'fields': ['*']}},
+                      'from': (page - 1) * per_page, 'size': per_page})
+        except (CircuitOpenError, ElasticsearchException) as e:
+            current_app.logger.warning('Search query failed: %s', e)
+            return None
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+
+class DatabaseBackend(object):
+    """Search backend that uses the full-text index created in the database
+    by fulltext_ddl. The database triggers (SQLite) or the index expression
+    (PostgreSQL) keep the index up to date within the same transaction as the
+    data, so there is nothing to send on commit."""
+
+    def add(self, index, id, payload):
+        pass
+
+    def remove(self, index, id):
+        pass
+
+    def bulk(self, actions):
+        return set()
+
+    def rebuild(self, index, fields):
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(
+                "INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(index))
+            db.session.commit()
+        return True
+
+    def query(self, index, query, page, per_page):
+        """Returns the ids of the best matching rows for any of the words of
+        the query and the total number of matching rows."""
+        words = query.split()
+        if not words:
+            return [], 0
+        dialect = db.engine.dialect.name
+        params = {'limit': per_page, 'offset': (page - 1) * per_page}
+        if dialect == 'sqlite':
+            # Every word is quoted so that the query can't use FTS5 syntax
+            params['query'] = ' OR '.join(
+                '"{}"'.format(word.replace('"', '""')) for word in words)
+            match = 'FROM {0}_fts WHERE {0}_fts MATCH :query'.format(index)
+            ids = db.session.execute(text(
+                'SELECT rowid ' + match +
+                ' ORDER BY rank LIMIT :limit OFFSET :offset'), params)
+            total = db.session.execute(text('SELECT count(*) ' + match),
+                                       params)
+        elif dialect == 'postgresql':
+            from blog.models import SearchableMixin
+            fields = [model.__searchable__
+                      for model in SearchableMixin.__subclasses__()
+                      if model.__tablename__ == index][0]
+            params['query'] = ' | '.join("'{}'".format(
+                word.replace('\\', '\\\\').replace("'", "''"))
+                for word in words)
+            vector = _tsvector(fields)
+            match = ('FROM {} WHERE {} @@ to_tsquery(\'simple\', :query)'
+                     .format(index, vector))
+            ids = db.session.execute(text(
+                'SELECT id ' + match + ' ORDER BY ts_rank(' + vector +
+                ', to_tsquery(\'simple\', :query)) DESC '
+                'LIMIT :limit OFFSET :offset'), params)
+            total = db.session.execute(text('SELECT count(*) ' + match),
+                                       params)
+        else:
+            return [], 0
+        return [row[0] for row in ids], total.scalar()
+
+
+_backends = {
+    'elasticsearch': ElasticsearchBackend(),
+    'database': DatabaseBackend(),
+}
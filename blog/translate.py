@@ -5,40 +5,196 @@
 
 import json
 import uuid
+from hashlib import sha1
 import requests
 from flask import current_app
 from flask_babel import _
+from sqlalchemy.exc import IntegrityError
+from blog import db
+from blog.cache import Cache
+from blog.clients import CircuitOpenError
+from blog.models import Translation
 
+# Maximum number of texts in one request to the translation service
+MAX_BATCH_SIZE = 100
 
-def translate(text, dest_language):
+
+class TranslationCache(object):
+    """Two-level cache of translations: an in-process LRU cache in front of
+    the translation table of the database, which survives restarts. The
+    entries are keyed by (sha1 of the text, source language, destination
+    language)."""
+
+    def __init__(self, maxsize=1024):
+        self.memory = Cache(maxsize=maxsize)
+        self.db_hits = 0
+        self.db_misses = 0
+
+    @staticmethod
+    def key(text, dest_language, source_language=None):
+        """Returns the cache key of a text to translate."""
+        return (sha1(text.encode('utf-8')).hexdigest(), source_language or '',
+                dest_language)
+
+    def get(self, key):
+        """Returns the cached translation for a key or None."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Returns a dictionary of the cached translations of the keys found
+        in the cache. The keys missing from memory are looked up with a
+        single database query."""
+        found = {}
+        missing = []
+        for key in keys:
+            text = self.memory.get(key)
+            if text is None:
+                missing.append(key)
+            else:
+                found[key] = text
+        if not missing:
+            return found
+        wanted = set(missing)
+        for translation in Translation.query.filter(
+                Translation.text_hash.in_({key[0] for key in missing}),
+                Translation.dest_language.in_({key[2] for key in missing})):
+            key = (translation.text_hash, translation.source_language,
+                   translation.dest_language)
+            if key in wanted:
+                found[key] = translation.text
+                self.memory.set(key, translation.text)
+        hits = len(wanted.intersection(found))
+        self.db_hits += hits
+        self.db_misses += len(wanted) - hits
+        return found
+
+    def set(self, key, text):
+        """Caches the translation for a key in memory and in the database."""
+        self.set_many({key: text})
+
+    def set_many(self, translations):
+        """Caches a dictionary of translations by key in memory and in the
+        database. The translations are written through a connection of their
+        own, so the pending changes of the session are not committed with
+        them."""
+        for key, text in translations.items():
+            self.memory.set(key, text)
+        table = Translation.__table__
+        rows = [{'text_hash': key[0], 'source_language': key[1],
+                 'dest_language': key[2], 'text': text}
+                for key, text in translations.items()]
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert(), rows)
+        except IntegrityError:
+            # Another request has stored some of the translations meanwhile
+            with db.engine.begin() as connection:
+                for row in rows:
+                    connection.execute(table.delete().where(db.and_(
+                        table.c.text_hash == row['text_hash'],
+                        table.c.source_language == row['source_language'],
+                        table.c.dest_language == row['dest_language'])))
+                connection.execute(table.insert(), rows)
+
+    def stats(self):
+        """Returns the hit and miss counters of both cache levels."""
+        return {'memory_hits': self.memory.hits,
+                'memory_misses': self.memory.misses,
+                'db_hits': self.db_hits, 'db_misses': self.db_misses}
+
+
+def translate(text, dest_language, source_language=None):
     """Return a translation text for a source text which will be mostly
-    present in the body of a post."""
+    present in the body of a post. Translations are looked up in the
+    application translation cache first, and only the texts that were never
+    translated before are sent to the translation service."""
+    return translate_many([(text, source_language)], dest_language)[0]
+
+
+def translate_many(texts, dest_language):
+    """Returns the translations of a list of (text, source language) pairs,
+    in the same order. The source language may be None to let the service
+    detect it. The texts are stripped of their surrounding whitespace, so
+    the text of a post read from a page shares its cache entry with the
+    post body.
+
+    The texts missing from the translation cache are sent to the translation
+    service together, in as few requests as its limits allow (see
+    MAX_BATCH_SIZE). The texts are returned untranslated when the service
+    fails."""
 
     if 'MS_TRANSLATOR_KEY' not in current_app.config or \
        not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: The translation key is not configured.')
+        return [_('Error: The translation key is not configured.')] * \
+            len(texts)
+
+    texts = [(text.strip(), source_language)
+             for text, source_language in texts]
+    cache = current_app.translation_cache
+    keys = [cache.key(text, dest_language, source_language)
+            for text, source_language in texts]
+    translations = cache.get_many(keys)
+
+    pending = {}
+    for key, (text, source_language) in zip(keys, texts):
+        if key not in translations:
+            pending[key] = (text, source_language or None)
+    pending = list(pending.items())
+    failed = False
+    for start in range(0, len(pending), MAX_BATCH_SIZE):
+        chunk = pending[start:start + MAX_BATCH_SIZE]
+        # The service detects the language of every text by itself when the
+        # texts of the request don't share the same source language
+        languages = {source_language for key, (text, source_language)
+                     in chunk}
+        results = _request_translations(
+            [text for key, (text, source_language) in chunk], dest_language,
+            languages.pop() if len(languages) == 1 else None)
+        if results is None:
+            failed = True
+            continue
+        new = dict(zip([key for key, value in chunk], results))
+        cache.set_many(new)
+        translations.update(new)
+
+    if failed:
+        # The texts are left untranslated while the service is unavailable
+        return [translations.get(key, text)
+                for key, (text, source_language) in zip(keys, texts)]
+    return [translations[key] for key in keys]
+
 
-    base_url = 'https://api.cognitive.microsofttranslator.com'
+def _request_translations(texts, dest_language, source_language=None):
+    """Sends a list of texts to the translation service in one request and
+    returns their translations, or None when the service failed. The request
+    goes through the translator client of the application, which bounds it
+    with a timeout and fails fast while the service is down."""
+    base_url = current_app.config['MS_TRANSLATOR_URL']
     path = '/translate'
     construct_url = base_url + path
     params = {
         'api-version': '3.0',
         'to': dest_language,
     }
+    if source_language:
+        params['from'] = source_language
     headers = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
         'Content-Type': 'application/json; charset=UTF-8',
         'X-ClientTraceId': str(uuid.uuid4()),
     }
-    body = [{
-        'Text': text,
-    }]
-    response = requests.post(construct_url, params=params, headers=headers,
-                             json=body)
+    body = [{'Text': text} for text in texts]
+    try:
+        response = current_app.translator.post(
+            construct_url, params=params, headers=headers, json=body)
+    except (requests.RequestException, CircuitOpenError) as e:
+        current_app.logger.warning('Translation service failed: %s', e)
+        return None
 
     if response.status_code != 200:
-        return _('Error: The translation service failed.')
+        current_app.logger.warning('Translation service failed: %s %s',
+                                   response.status_code, response.text)
+        return None
 
     r = json.loads(response.content.decode('utf-8'))
-    text = r[0]['translations'][0]['text']
-    return text
+    return [item['translations'][0]['text'] for item in r]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Logged in user caching module for Blogger App.
+
+Flask-Login loads the current user from the database at the start of every
+authenticated request, for the same few users over and over. The user cache
+keeps detached, read-only snapshots of the column values of the users
+loaded, and gives every request its own copy of the snapshot attached to the
+request session without querying the database. The users committed by the
+process are dropped from the cache (see the session events of blog.models);
+the changes made by other processes show up when the snapshots expire.
+
+The views that change the current user get a fresh instance loaded from the
+database: the requests other than GET and the views decorated with
+fresh_user."""
+
+from threading import Lock
+from flask import current_app, request
+from sqlalchemy.orm import make_transient_to_detached
+from blog import db
+from blog.cache import Cache
+
+
+class UserCache(object):
+    """Cache of at most maxsize user snapshots, which expire after ttl
+    seconds."""
+
+    def __init__(self, maxsize=10000, ttl=5):
+        self._cache = Cache(maxsize=maxsize, ttl=ttl)
+        self._invalidations = 0
+        self._lock = Lock()
+
+    def load(self, id, loader):
+        """Returns the user with an id, attached to the session of the
+        request: a copy of its cached snapshot, or the user returned by the
+        loader function called with the id, whose snapshot is then cached."""
+        snapshot = self._cache.get(id)
+        if snapshot is not None:
+            return db.session.merge(snapshot, load=False)
+        invalidations = self._invalidations
+        user = loader(id)
+        # A snapshot loaded while the users were being changed may be stale
+        if user is not None and invalidations == self._invalidations:
+            self._cache.set(id, self._snapshot(user))
+        return user
+
+    @staticmethod
+    def _snapshot(user):
+        mapper = db.inspect(user).mapper
+        snapshot = mapper.class_()
+        for attr in mapper.column_attrs:
+            setattr(snapshot, attr.key, getattr(user, attr.key))
+        make_transient_to_detached(snapshot)
+        return snapshot
+
+    def invalidate(self, ids):
+        """Drops the snapshots of the users with the given ids."""
+        with self._lock:
+            self._invalidations += 1
+        for id in ids:
+            self._cache.delete(id)
+
+    def stats(self):
+        """Returns the number of cached users, the hit and miss counters and
+        the hit rate."""
+        hits, misses = self._cache.hits, self._cache.misses
+        return {'size': len(self._cache), 'hits': hits, 'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+
+def fresh_user(view):
+    """Decorator for the GET views that change the current user, which get a
+    fresh instance loaded from the database instead of a cached snapshot. It
+    goes right below the route decorator."""
+    view.fresh_user = True
+    return view
+
+
+def needs_fresh_user():
+    """Returns whether the current request must load the current user from
+    the database."""
+    if request.method not in ('GET', 'HEAD'):
+        return True
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'fresh_user', False)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Background workers module for Blogger App. It runs the jobs that are kept
+out of the request path, such as sending the search index updates or
+detecting the language of the new posts."""
+
+from threading import Event, Thread
+from blog import db
+
+
+class BackgroundWorker(Thread):
+    """Daemon thread that calls a job function within the application context
+    over and over. The job returns the amount of work it has done, and the
+    worker waits for interval seconds whenever there was nothing to do, or
+    until it is woken up."""
+
+    def __init__(self, app, job, interval):
+        super(BackgroundWorker, self).__init__(daemon=True)
+        self.app = app
+        self.job = job
+        self.interval = interval
+        self._stopped = Event()
+        self._woken = Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            with self.app.app_context():
+                try:
+                    done = self.job()
+                except Exception:
+                    self.app.logger.exception('Background job %s failed',
+                                              self.job.__name__)
+                    done = 0
+                finally:
+                    db.session.remove()
+            if not done:
+                self._woken.wait(self.interval)
+            self._woken.clear()
+
+    def wake(self):
+        """Asks the worker to run its job now if it is waiting."""
+        self._woken.set()
+
+    def stop(self):
+        """Asks the worker to stop and waits for its current job to end."""
+        self._stopped.set()
+        self._woken.set()
+        self.join()
@@ -20,22 +20,143 @@ class Config(object):
         'sqlite:///' + os.path.join(basedir, 'blog.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Read replicas of the database, as a comma separated list of URLs. The
+    # reads of the GET requests go to one of them, except for the clients
+    # that wrote in the last stickiness seconds, which read their own writes
+    # from the primary database
+    DATABASE_REPLICA_URLS = [
+        url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if url]
+    DATABASE_REPLICA_STICKINESS = int(
+        os.environ.get('DATABASE_REPLICA_STICKINESS') or 10)
+
     # Email Server settings
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+
+    # Outgoing email queue: number of worker threads, size of the queue,
+    # seconds a request waits for room in a full queue, number of emails sent
+    # over one SMTP connection and retries of transient failures (with a
+    # delay in seconds doubled after every failure)
+    EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS') or 2)
+    EMAIL_QUEUE_SIZE = int(os.environ.get('EMAIL_QUEUE_SIZE') or 1000)
+    EMAIL_QUEUE_TIMEOUT = float(os.environ.get('EMAIL_QUEUE_TIMEOUT') or 5)
+    EMAIL_BATCH_SIZE = int(os.environ.get('EMAIL_BATCH_SIZE') or 20)
+    EMAIL_RETRIES = 3
+    EMAIL_RETRY_DELAY = 1
     ADMINS = ['habdin@gmail.com']
 
     # Pagination Support
     POSTS_PER_PAGE = 10
 
+    # Read the home page posts from the precomputed timeline table
+    HOME_TIMELINE = os.environ.get('HOME_TIMELINE') is not None
+
+    # Buffered last seen time updates (all in seconds except the threshold
+    # which is a number of users)
+    LAST_SEEN_STALENESS = int(os.environ.get('LAST_SEEN_STALENESS') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(
+        os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+    LAST_SEEN_FLUSH_THRESHOLD = int(
+        os.environ.get('LAST_SEEN_FLUSH_THRESHOLD') or 100)
+
+    # Longest time (in seconds) a notifications request waits for new
+    # notifications before answering. Long polling needs a threaded or
+    # asynchronous server since every waiting browser tab holds a worker.
+    NOTIFICATIONS_MAX_WAIT = int(os.environ.get('NOTIFICATIONS_MAX_WAIT') or 25)
+
     # Localization and Internationalization
     LANGUAGES = ['en', 'ar']
 
     # MS Translator azure service key
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+        'https://api.cognitive.microsofttranslator.com'
+
+    # Timeout in seconds of the requests to the translation service
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5)
+
+    # Number of translations kept in memory in front of the translation table
+    TRANSLATION_CACHE_SIZE = int(
+        os.environ.get('TRANSLATION_CACHE_SIZE') or 10000)
+
+    # Outbound connections to the external services: number of keep-alive
+    # connections kept for each service, and the circuit breakers (number of
+    # consecutive failures that open the breaker and the seconds it stays
+    # open)
+    SERVICES_POOL_SIZE = int(os.environ.get('SERVICES_POOL_SIZE') or 10)
+    CIRCUIT_BREAKER_THRESHOLD = int(
+        os.environ.get('CIRCUIT_BREAKER_THRESHOLD') or 5)
+    CIRCUIT_BREAKER_RESET = int(os.environ.get('CIRCUIT_BREAKER_RESET') or 30)
 
     # Elasticsearch service configuration
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_BULK_SIZE = int(os.environ.get('SEARCH_BULK_SIZE') or 500)
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 5)
+
+    # Full-text search backend, either 'elasticsearch' or 'database'
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or \
+        ('elasticsearch' if ELASTICSEARCH_URL else 'database')
+
+    # Search results cache (number of cached result pages and their time to
+    # live in seconds)
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)
+
+    # Rendered fragments cache (number of fragments kept in memory, or the
+    # URL of a Redis server shared by all the processes, and their time to
+    # live in seconds)
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL')
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 3600)
+
+    # Buffer of the newest posts the explore pages are served from (number of
+    # posts kept in memory, 0 to disable it, and seconds between two loads of
+    # the buffer, which bound how long the posts of other processes take to
+    # show up)
+    RECENT_POSTS_SIZE = int(os.environ.get('RECENT_POSTS_SIZE') or 500)
+    RECENT_POSTS_TTL = int(os.environ.get('RECENT_POSTS_TTL') or 10)
+
+    # Cache of the user ids of the usernames and emails, including the
+    # missing ones (number of entries kept in memory and their time to live
+    # in seconds, which bounds how long a user registered by another process
+    # may be reported missing)
+    USER_IDS_CACHE_SIZE = int(os.environ.get('USER_IDS_CACHE_SIZE') or 10000)
+    USER_IDS_CACHE_TTL = int(os.environ.get('USER_IDS_CACHE_TTL') or 300)
+
+    # Cache of the logged in users loaded at the start of the requests
+    # (number of users kept in memory and seconds before the changes made by
+    # other processes show up; no cache by default)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 0)
+
+    # Seconds the browsers keep the user popups before asking again
+    USER_POPUP_MAX_AGE = int(os.environ.get('USER_POPUP_MAX_AGE') or 60)
+
+    # Send the search index updates through the outbox table, drained by a
+    # background worker (in seconds for the interval and retry delays). The
+    # worker runs with SEARCH_OUTBOX_WORKER, or else 'flask search drain
+    # --watch' drains the outbox. Without SEARCH_OUTBOX, the outbox only holds
+    # the updates that failed after their commit, and the worker always runs
+    # with Elasticsearch
+    SEARCH_OUTBOX = os.environ.get('SEARCH_OUTBOX') is not None
+    SEARCH_OUTBOX_WORKER = os.environ.get('SEARCH_OUTBOX_WORKER') is not None
+    SEARCH_OUTBOX_INTERVAL = int(os.environ.get('SEARCH_OUTBOX_INTERVAL') or 5)
+    SEARCH_OUTBOX_RETRY_DELAY = 2
+    SEARCH_OUTBOX_MAX_DELAY = 600
+
+    # Seconds between two checks of the follower, followed and post counters
+    # of the users by a background worker (no checks by default)
+    COUNTERS_CHECK_INTERVAL = int(
+        os.environ.get('COUNTERS_CHECK_INTERVAL') or 0)
+
+    # Detect the language of the new posts in a background worker, which
+    # looks for posts without a language every interval seconds besides being
+    # woken up when posts are committed (set LANGUAGE_WORKER to 'off' when it
+    # runs elsewhere)
+    LANGUAGE_WORKER = os.environ.get('LANGUAGE_WORKER') != 'off'
+    LANGUAGE_WORKER_INTERVAL = int(
+        os.environ.get('LANGUAGE_WORKER_INTERVAL') or 60)
@@ -0,0 +1,60 @@
+"""followers primary key and indexes
+
+Revision ID: 8f4e2b6d1a93
+Revises: 3c1d5e7a9b20
+Create Date: 2026-10-18 11:40:05.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f4e2b6d1a93'
+down_revision = '3c1d5e7a9b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The primary key needs complete and unique rows: drop the rows with a
+    # missing user, and keep one row of each duplicated pair
+    followers = sa.table('followers', sa.column('follower_id', sa.Integer),
+                         sa.column('followed_id', sa.Integer))
+    op.execute(followers.delete().where(sa.or_(
+        followers.c.follower_id.is_(None), followers.c.followed_id.is_(None))))
+    connection = op.get_bind()
+    duplicates = connection.execute(
+        sa.select([followers.c.follower_id, followers.c.followed_id]).group_by(
+            followers.c.follower_id, followers.c.followed_id).having(
+                sa.func.count() > 1)).fetchall()
+    for follower_id, followed_id in duplicates:
+        connection.execute(followers.delete().where(sa.and_(
+            followers.c.follower_id == follower_id,
+            followers.c.followed_id == followed_id)))
+        connection.execute(followers.insert().values(
+            follower_id=follower_id, followed_id=followed_id))
+    # Batch mode recreates the table on SQLite, which cannot add a primary
+    # key to an existing table.
+    with op.batch_alter_table('followers', recreate='always') as batch_op:
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(),
+                              nullable=False)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(),
+                              nullable=False)
+        batch_op.create_primary_key('pk_followers',
+                                    ['follower_id', 'followed_id'])
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+    op.create_index('ix_message_recipient_id_timestamp', 'message', ['recipient_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_recipient_id_timestamp', table_name='message')
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    with op.batch_alter_table('followers', recreate='always') as batch_op:
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(),
+                              nullable=True)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(),
+                              nullable=True)
@@ -0,0 +1,49 @@
+"""post full-text index
+
+Revision ID: d5e7f9a1b3c6
+Revises: b2d4f6a8c0e1
+Create Date: 2026-10-18 16:48:39.102754
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e7f9a1b3c6'
+down_revision = 'b2d4f6a8c0e1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE post_fts USING fts5(body, "
+                   "content='post', content_rowid='id')")
+        op.execute("CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN "
+                   "INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); "
+                   "END")
+        op.execute("CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN "
+                   "INSERT INTO post_fts(post_fts, rowid, body) "
+                   "VALUES ('delete', old.id, old.body); END")
+        op.execute("CREATE TRIGGER post_fts_update AFTER UPDATE ON post BEGIN "
+                   "INSERT INTO post_fts(post_fts, rowid, body) "
+                   "VALUES ('delete', old.id, old.body); "
+                   "INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); "
+                   "END")
+        op.execute("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+    elif dialect == 'postgresql':
+        op.execute("CREATE INDEX ix_post_fulltext ON post USING gin "
+                   "(to_tsvector('simple', coalesce(body, '')))")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS post_fts_update')
+        op.execute('DROP TRIGGER IF EXISTS post_fts_delete')
+        op.execute('DROP TRIGGER IF EXISTS post_fts_insert')
+        op.execute('DROP TABLE IF EXISTS post_fts')
+    elif dialect == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_post_fulltext')
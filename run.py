@@ -4,7 +4,9 @@
 """Blogger Flask App runner module"""
 
 from blog import create_app, db, cli
-from blog.models import User, Post, Notification, Message
+from blog.models import (
+    User, Post, Notification, Message, Timeline, SearchOutbox, Translation
+)
 
 
 app = create_app()
@@ -20,4 +22,7 @@ def make_shell_context():
         'Post': Post,
         'Message': Message,
         'Notification': Notification,
+        'Timeline': Timeline,
+        'SearchOutbox': SearchOutbox,
+        'Translation': Translation,
     }
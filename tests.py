@@ -4,9 +4,23 @@
 """Module that defines unittests for Blogger App"""
 
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import socketserver
+import tempfile
+from threading import Thread
+import time
 import unittest
+import elasticsearch
+from werkzeug.http import http_date
 from blog import create_app, db
-from blog.models import User, Post
+from blog.models import (
+    User, Post, Message, Notification, Timeline, SearchOutbox, Translation
+)
+from blog.pagination import keyset_paginate, encode_cursor, decode_cursor
+from blog.cache import Cache
+from blog.recent import RecentPosts
 from config import Config
 
 class TestConfig(Config):
@@ -14,6 +28,195 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
+
+class FakeElasticsearch(object):
+    """Local stand-in for the Elasticsearch client that keeps the documents
+    in memory and records the requests made to it. Setting the fail attribute
+    makes all the requests raise an error."""
+
+    def __init__(self):
+        self.documents = {}
+        self.requests = []
+        self.fail = False
+
+    def index(self, index, id, body):
+        self.requests.append(('index', index, id))
+        self.documents[(index, str(id))] = body
+
+    def delete(self, index, id):
+        self.requests.append(('delete', index, id))
+        self.documents.pop((index, str(id)), None)
+
+    def bulk(self, body):
+        self.requests.append(('bulk', len(body)))
+        if self.fail:
+            raise elasticsearch.ConnectionError(
+                'N/A', 'search cluster is down', None)
+        lines = iter(body)
+        for line in lines:
+            (action, meta), = line.items()
+            key = (meta['_index'], str(meta['_id']))
+            if action == 'index':
+                self.documents[key] = next(lines)
+            else:
+                self.documents.pop(key, None)
+        return {'errors': False, 'items': []}
+
+    def search(self, index, body):
+        self.requests.append(('search', index))
+        if self.fail:
+            raise elasticsearch.ConnectionError(
+                'N/A', 'search cluster is down', None)
+        words = body['query']['multi_match']['query'].lower().split()
+        hits = [{'_id': id} for (i, id), doc in sorted(self.documents.items())
+                if i == index and any(w in str(v).lower().split()
+                                      for v in doc.values() for w in words)]
+        start = body['from']
+        return {'hits': {'hits': hits[start:start + body['size']],
+                         'total': {'value': len(hits)}}}
+
+
+class FakeTranslator(object):
+    """Local HTTP server standing in for the translation service. It
+    "translates" a text by prefixing it with the destination language and
+    records the requests made to it along with the client port, which tells
+    the connections apart. Setting the fail attribute makes it answer with an
+    error, and setting the delay attribute makes it answer after that many
+    seconds."""
+
+    def __init__(self):
+        self.requests = []
+        self.ports = []
+        self.fail = False
+        self.delay = 0
+        translator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+                translator.requests.append((self.path, body))
+                translator.ports.append(self.client_address[1])
+                time.sleep(translator.delay)
+                if translator.fail:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                language = self.path.split('to=')[1].split('&')[0]
+                payload = json.dumps([
+                    {'translations': [{'text': '{}: {}'.format(
+                        language, item['Text']), 'to': language}]}
+                    for item in body]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeSMTPServer(object):
+    """Local SMTP server standing in for the mail server. It records the
+    messages it receives and the number of connections made to it. Setting
+    the fail attribute to a number makes it refuse that many of the next
+    messages with a transient error, and setting the delay attribute makes it
+    take that many seconds to accept each message."""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self.fail = 0
+        self.delay = 0
+        smtp = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                smtp.connections += 1
+                self.reply('220 localhost ready')
+                recipients = []
+                for line in self.rfile:
+                    command = line.decode('ascii').strip()
+                    verb = command[:4].upper()
+                    if verb in ('HELO', 'EHLO', 'RSET', 'NOOP'):
+                        self.reply('250 OK')
+                    elif verb == 'MAIL':
+                        if smtp.fail:
+                            smtp.fail -= 1
+                            self.reply('451 Try again later')
+                            continue
+                        recipients = []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        recipients.append(command.split(':', 1)[1].strip('<>'))
+                        self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        for line in self.rfile:
+                            if line == b'.\r\n':
+                                break
+                            data.append(line)
+                        time.sleep(smtp.delay)
+                        smtp.messages.append((recipients, b''.join(data)))
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Not implemented')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class QueryCounter(object):
+    """Context manager that records the SQL statements run on the database
+    engine with their parameters."""
+
+    def __enter__(self):
+        self.statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *args):
+        db.event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, *args):
+        self.statements.append((statement, parameters))
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def writes(self):
+        """Returns the statements that are not plain reads."""
+        return [statement for statement, _ in self.statements
+                if not statement.lstrip().upper().startswith('SELECT')]
+
 class UserModelCase(unittest.TestCase):
     """Tests for User Model methods"""
 
@@ -41,6 +244,14 @@ class UserModelCase(unittest.TestCase):
                                           'd4c74594d841139328695756648b6bd6'
                                           '?d=identicon&s=128'))
 
+    def test_avatar_digest(self):
+        u = User(username='john', email="john@example.com")
+        self.assertEqual(u.email_digest, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertNotEqual(u.email_digest,
+                            'd4c74594d841139328695756648b6bd6')
+        self.assertIn(u.email_digest, u.avatar(64))
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -102,6 +313,1583 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_home_timeline(self):
+        self.app.config['HOME_TIMELINE'] = True
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)           # john follows susan
+        db.session.commit()
+
+        # new posts are pushed to the timelines of the author's followers
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body='post from susan', author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        p3 = Post(body='post from mary', author=u3,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2, p3])
+        db.session.flush()
+        for p in [p1, p2, p3]:
+            p.fan_out()
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p2, p1])
+        self.assertEqual(u2.followed_posts().all(), [p2])
+
+        # following and unfollowing updates the timeline
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p2, p3, p1])
+        page = keyset_paginate(u1.followed_posts(), User.followed_posts_keys(),
+                               2)
+        self.assertEqual(page.items, [p2, p3])
+        page = keyset_paginate(u1.followed_posts(), User.followed_posts_keys(),
+                               2, before=page.next_cursor)
+        self.assertEqual(page.items, [p1])
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p1])
+
+        # rebuilding gives the same result as the incremental updates
+        self.assertEqual(Timeline.rebuild(), 4)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p1])
+        self.assertEqual(u3.followed_posts().all(), [p3])
+
+    def test_unread_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add_all([Message(author=u1, recipient=u2, body='hi'),
+                            Message(author=u1, recipient=u2, body='hey'),
+                            Message(author=u2, recipient=u1, body='hello')])
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 2)
+        self.assertEqual(u1.new_messages(), 1)
+
+        # messages read before the last read time don't count
+        u2.last_message_read_time = datetime.utcnow() + timedelta(seconds=1)
+        u1.unread_count = 7
+        db.session.commit()
+        self.assertEqual(User.reconcile_unread_counts(), 2)
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 0)
+        self.assertEqual(u1.new_messages(), 1)
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u2.follow(u3)
+        p1 = Post(body='post one', author=u1)
+        db.session.add_all([p1, Post(body='post two', author=u1),
+                            Post(body='post three', author=u3)])
+        db.session.commit()
+        self.assertEqual([(u.follower_count, u.followed_count, u.post_count)
+                          for u in (u1, u2, u3)],
+                         [(0, 2, 2), (1, 1, 0), (2, 0, 1)])
+
+        u1.unfollow(u3)
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.post_count), (1, 1))
+        self.assertEqual(u3.follower_count, 1)
+        self.assertEqual(User.check_counters(), {})
+
+        u2.post_count = 5
+        u3.follower_count = 0
+        db.session.commit()
+        self.assertEqual(User.check_counters(fix=True), {
+            u2.id: {'post_count': (5, 0)},
+            u3.id: {'follower_count': (0, 1)}})
+        db.session.commit()
+        self.assertEqual((u2.post_count, u3.follower_count), (0, 1))
+        self.assertEqual(User.check_counters(), {})
+
+
+class UserIdsCase(unittest.TestCase):
+    """Tests for the cached resolution of usernames and emails to users"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('password')
+        db.session.add(self.john)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_lookups(self):
+        db.session.remove()
+        with QueryCounter() as queries:
+            john = User.by_username('john')
+            self.assertIs(User.by_username('john'), john)
+            self.assertIs(User.by_email('john@example.com'), john)
+        # the second lookup is a get from the session
+        self.assertEqual(queries.count, 2)
+
+        # missing users are cached too
+        with QueryCounter() as queries:
+            self.assertIsNone(User.by_username('susan'))
+            self.assertIsNone(User.by_username('susan'))
+        self.assertEqual(queries.count, 1)
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.assertEqual(User.by_username('susan').email, 'susan@example.com')
+
+        # a user renamed by another process is looked up again
+        id = john.id
+        db.session.execute(User.__table__.update().where(
+            User.id == id).values(username='johnny'))
+        db.session.commit()
+        db.session.remove()
+        self.assertIsNone(User.by_username('john'))
+        self.assertEqual(User.by_username('johnny').id, id)
+
+        # a user registered by another process is only found by the checks
+        # that don't trust the missing users
+        self.assertIsNone(User.by_username('david'))
+        db.session.execute(User.__table__.insert().values(
+            username='david', email='david@example.com'))
+        db.session.commit()
+        self.assertIsNone(User.by_username('david'))
+        self.assertIsNotNone(User.by_username('david', recheck_missing=True))
+
+    def test_rename(self):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john',
+                                          'password': 'password'})
+        self.assertEqual(client.get('/user/johnny').status_code, 404)
+        response = client.post('/edit_profile', data={'username': 'johnny',
+                                                      'about_me': ''})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(client.get('/user/johnny').status_code, 200)
+        self.assertEqual(client.get('/user/john').status_code, 404)
+        self.assertEqual(client.get('/user/john/popup').status_code, 404)
+
+
+class UserCacheConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+    USER_CACHE_TTL = 60
+
+
+class UserCacheCase(unittest.TestCase):
+    """Tests for the cache of the logged in users"""
+
+    def setUp(self):
+        self.app = create_app(UserCacheConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('password')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'password'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def user_queries(self, method, url, **kwargs):
+        """Returns the response to a request and the number of times it
+        loaded the user table."""
+        db.session.remove()
+        with QueryCounter() as queries:
+            response = self.client.open(url, method=method, **kwargs)
+        return response, len([statement for statement, _ in queries.statements
+                              if statement.lstrip().startswith('SELECT') and
+                              'FROM user' in statement and
+                              'user.id = ?' in statement])
+
+    def test_cache(self):
+        cache = self.app.user_cache
+        self.user_queries('GET', '/explore')
+        # the user is a copy of the snapshot attached to the session, whose
+        # relationships still work
+        response, loads = self.user_queries('GET', '/index')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads, 0)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # the requests that change the user load it from the database
+        self.user_queries('POST', '/follow/susan')
+        self.user_queries('GET', '/messages')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # and the users committed are loaded again
+        response, loads = self.user_queries('GET', '/user/john')
+        self.assertEqual(loads, 1)
+        self.assertIn(b'1 following', response.data)
+        response, loads = self.user_queries('GET', '/user/john')
+        self.assertEqual(loads, 0)
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+        User.by_username('susan').follow(User.by_username('john'))
+        db.session.commit()
+        response, loads = self.user_queries('GET', '/user/john')
+        self.assertEqual(loads, 1)
+        self.assertIn(b'1 followers', response.data)
+
+
+class ReplicaConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'primary.db')
+    DATABASE_REPLICA_URLS = ['sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'replica.db')]
+
+
+class ReplicaCase(unittest.TestCase):
+    """Tests for the routing of the reads to the read replicas"""
+
+    def setUp(self):
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        john = User(username='john', email='john@example.com')
+        john.set_password('password')
+        db.session.add(john)
+        db.session.commit()
+        self.replicate()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'password'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def replicate(self):
+        """Copies the primary database to the replica, like the replication
+        would eventually do."""
+        db.session.remove()
+        replica = db.get_engine(self.app, bind='replica0')
+        replica.dispose()
+        with open(self.app.config['SQLALCHEMY_DATABASE_URI'][10:], 'rb') as f:
+            data = f.read()
+        with open(self.app.config['DATABASE_REPLICA_URLS'][0][10:],
+                  'wb') as f:
+            f.write(data)
+
+    def get(self, url):
+        db.session.remove()
+        return self.client.get(url).get_data(as_text=True)
+
+    def test_routing(self):
+        # the writes and the reads outside of the requests use the primary
+        db.session.add(Post(body='first post',
+                            author=User.query.filter_by(username='john')[0]))
+        db.session.commit()
+        self.assertEqual(Post.query.count(), 1)
+        self.assertNotIn('first post', self.get('/user/john'))
+        self.replicate()
+        self.assertIn('first post', self.get('/user/john'))
+
+        # the client that wrote reads its own writes from the primary
+        self.client.post('/index', data={'post': 'second post'})
+        self.assertIn('second post', self.get('/user/john'))
+        other = self.app.test_client()
+        other.post('/auth/login', data={'username': 'john',
+                                        'password': 'password'})
+        db.session.remove()
+        self.assertNotIn('second post',
+                         other.get('/user/john').get_data(as_text=True))
+
+        # until the stickiness window is over
+        self.app.config['DATABASE_REPLICA_STICKINESS'] = 0
+        self.assertNotIn('second post', self.get('/user/john'))
+
+    def test_long_polling(self):
+        # the long polling requests wait for the commits of the primary
+        User.query.filter_by(username='john')[0].add_notification(
+            'unread_message_count', 1)
+        db.session.commit()
+        self.assertEqual(self.get('/notifications?since=0'), '[]\n')
+        self.assertIn('unread_message_count',
+                      self.get('/notifications?since=0&wait=0.01'))
+
+
+class KeysetPaginationCase(unittest.TestCase):
+    """Tests for the keyset pagination of the feeds"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        now = datetime.utcnow()
+        # pairs of posts share a timestamp to exercise the id tie breaker
+        self.posts = [Post(body='post {}'.format(i), author=self.user,
+                           timestamp=now + timedelta(seconds=i // 2))
+                      for i in range(25)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+        self.newest_first = sorted(self.posts, reverse=True,
+                                   key=lambda p: (p.timestamp, p.id))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def paginate(self, before=None, after=None):
+        return keyset_paginate(Post.query, (Post.timestamp, Post.id), 10,
+                               before=before, after=after)
+
+    def test_cursor(self):
+        now = datetime.utcnow()
+        self.assertEqual(decode_cursor(encode_cursor(now, 42)), (now, 42))
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+        self.assertIsNone(decode_cursor(None))
+
+    def test_walk_pages(self):
+        pages = [self.paginate()]
+        while pages[-1].has_next:
+            pages.append(self.paginate(before=pages[-1].next_cursor))
+        self.assertEqual([len(p.items) for p in pages], [10, 10, 5])
+        self.assertEqual(sum([p.items for p in pages], []), self.newest_first)
+        self.assertFalse(pages[0].has_prev)
+
+        # walking back gives the same pages
+        newer = self.paginate(after=pages[2].prev_cursor)
+        self.assertEqual(newer.items, pages[1].items)
+        newer = self.paginate(after=newer.prev_cursor)
+        self.assertEqual(newer.items, pages[0].items)
+        self.assertFalse(newer.has_prev)
+
+    def test_empty_page(self):
+        # a cursor older than every post, from a stale or edited link
+        cursor = encode_cursor(datetime(1900, 1, 1), 1)
+        page = self.paginate(before=cursor)
+        self.assertEqual(page.items, [])
+        self.assertFalse(page.has_next)
+        newer = self.paginate(after=page.prev_cursor)
+        self.assertEqual(newer.items, self.newest_first[-10:])
+
+        # and so does the recent posts buffer when it holds every post
+        recent = RecentPosts(maxsize=50, ttl=60)
+        page = recent.page(10, before=cursor)
+        self.assertEqual(page.items, [])
+        self.assertEqual(page.prev_cursor, cursor)
+
+    def test_new_posts_do_not_shift_pages(self):
+        first = self.paginate()
+        db.session.add(Post(body='new post', author=self.user,
+                            timestamp=datetime.utcnow() + timedelta(days=1)))
+        db.session.commit()
+        second = self.paginate(before=first.next_cursor)
+        self.assertEqual(second.items, self.newest_first[10:20])
+
+    def test_deep_pages_use_index_range(self):
+        cursor = encode_cursor(self.newest_first[-2].timestamp,
+                               self.newest_first[-2].id)
+        with QueryCounter() as queries:
+            page = self.paginate(before=cursor)
+        self.assertEqual(page.items, self.newest_first[-1:])
+        self.assertEqual(queries.count, 1)
+
+        # the deep page skips no rows and is an index range scan
+        statement, parameters = queries.statements[0]
+        self.assertEqual(parameters[-2:], (11, 0))
+        plan = ' '.join(str(row[-1]) for row in db.engine.execute(
+            'EXPLAIN QUERY PLAN ' + statement, parameters))
+        self.assertIn('SEARCH', plan)
+        self.assertIn('ix_post_timestamp', plan)
+
+
+class RecentPostsCase(unittest.TestCase):
+    """Tests for the buffer of the newest posts the explore pages are served
+    from"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.recent_posts = RecentPosts(maxsize=16, ttl=60)
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=self.user,
+                                 timestamp=now + timedelta(seconds=i // 2))
+                            for i in range(25)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def paginate(self, before=None, after=None):
+        return keyset_paginate(Post.query, (Post.timestamp, Post.id), 5,
+                               before=before, after=after)
+
+    def assertSamePage(self, page, expected):
+        self.assertEqual([post.id for post in page.items],
+                         [post.id for post in expected.items])
+        self.assertEqual((page.has_next, page.has_prev),
+                         (expected.has_next, expected.has_prev))
+
+    def test_pages(self):
+        recent = self.app.recent_posts
+        self.assertSamePage(recent.page(5), self.paginate())
+        self.assertEqual(recent.loads, 1)
+
+        # the pages within the buffer take no queries
+        with QueryCounter() as queries:
+            first = recent.page(5)
+            second = recent.page(5, before=first.next_cursor)
+            third = recent.page(5, before=second.next_cursor)
+            newer = recent.page(5, after=third.prev_cursor)
+        self.assertEqual(queries.count, 0)
+        self.assertSamePage(third, self.paginate(before=second.next_cursor))
+        self.assertSamePage(newer, self.paginate(after=third.prev_cursor))
+        self.assertEqual(third.items[0].author.username, 'john')
+
+        # the deeper pages are left to the database
+        self.assertIsNone(recent.page(5, before=third.next_cursor))
+        last = self.paginate(before=self.paginate(
+            before=third.next_cursor).next_cursor)
+        self.assertIsNone(recent.page(5, after=last.prev_cursor))
+        self.assertEqual(recent.stats()['misses'], 2)
+
+    def test_changes(self):
+        recent = self.app.recent_posts
+        recent.page(5)
+        post = Post(body='new post', author=self.user,
+                    timestamp=datetime.utcnow() + timedelta(days=1))
+        db.session.add(post)
+        db.session.commit()
+        page = recent.page(5)
+        self.assertEqual(page.items[0].id, post.id)
+        self.assertEqual(len(recent), 16)
+        self.assertEqual(recent.loads, 1)
+
+        # changed posts and authors are loaded again
+        post.language = 'en'
+        db.session.commit()
+        self.assertEqual(recent.page(5).items[0].language, 'en')
+        self.assertEqual(recent.loads, 2)
+        self.user.username = 'johnny'
+        db.session.commit()
+        self.assertEqual(recent.page(5).items[0].author.username, 'johnny')
+        self.assertEqual(recent.loads, 3)
+
+        # a new follower doesn't change the posts
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        User.query.filter_by(username='susan').first().follow(self.user)
+        db.session.commit()
+        recent.page(5)
+        self.assertEqual(recent.loads, 3)
+
+
+class QueryPlanCase(unittest.TestCase):
+    """Regression tests for the indexes used by the model queries"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def query_plan(self, func):
+        """Runs func and returns the query plan of the SQL it emitted."""
+        with QueryCounter() as queries:
+            func()
+        plan = []
+        for statement, parameters in queries.statements:
+            plan.extend(str(row[-1]) for row in db.engine.execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters))
+        return '\n'.join(plan)
+
+    def test_followers_indexes(self):
+        plan = self.query_plan(lambda: self.u1.is_following(self.u2))
+        self.assertIn('SEARCH followers USING COVERING INDEX '
+                      'sqlite_autoindex_followers_1', plan)
+        plan = self.query_plan(lambda: self.u2.followers.all())
+        self.assertIn('SEARCH followers USING COVERING INDEX '
+                      'ix_followers_followed_id_follower_id', plan)
+        plan = self.query_plan(lambda: self.u1.followed_posts().all())
+        self.assertIn('SEARCH followers USING COVERING INDEX '
+                      'sqlite_autoindex_followers_1', plan)
+        self.assertNotIn('SCAN followers', plan)
+
+    def test_feed_indexes(self):
+        plan = self.query_plan(lambda: self.u1.posts.order_by(
+            Post.timestamp.desc()).all())
+        self.assertIn('ix_post_user_id_timestamp', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        plan = self.query_plan(lambda: self.u1.messages_received.order_by(
+            Message.timestamp.desc()).all())
+        self.assertIn('ix_message_recipient_id_timestamp', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class FileDatabaseConfig(TestConfig):
+    # The in-memory database is a single connection shared by all the
+    # threads, so the tests of background threads use a database file
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'test.db')
+
+
+class LastSeenCase(unittest.TestCase):
+    """Tests for the buffered last seen time updates"""
+
+    def setUp(self):
+        self.app = create_app(FileDatabaseConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username='user{}'.format(i),
+                           email='user{}@example.com'.format(i))
+                      for i in range(3)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.tracker = self.app.last_seen
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        self.start = datetime.utcnow() + timedelta(minutes=10)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_staleness_window(self):
+        u = self.users[0]
+        self.tracker.touch(u, now=self.start)
+        self.tracker.touch(u, now=self.start + timedelta(seconds=10))
+        self.assertEqual(self.tracker.last_seen(u), self.start)
+        later = self.start + timedelta(seconds=61)
+        self.tracker.touch(u, now=later)
+        self.assertEqual(self.tracker.last_seen(u), later)
+
+    def test_bulk_flush(self):
+        self.app.config['LAST_SEEN_FLUSH_THRESHOLD'] = 3
+        for u in self.users:
+            db.session.refresh(u)
+        with QueryCounter() as queries:
+            for i, u in enumerate(self.users):
+                self.tracker.touch(u, now=self.start + timedelta(seconds=i))
+        self.assertEqual(queries.count, 1)
+        self.assertTrue(queries.statements[0][0].startswith('UPDATE user'))
+        self.assertIn('CASE', queries.statements[0][0])
+        db.session.expire_all()
+        self.assertEqual([u.last_seen for u in self.users],
+                         [self.start + timedelta(seconds=i) for i in range(3)])
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_worker(self):
+        u = self.users[0]
+        self.tracker.touch(u, now=self.start)
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 0.01
+        self.tracker.start(self.app)
+        deadline = time.time() + 5
+        while self.tracker._pending and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.tracker._pending, {})
+
+        # the buffer is written when the worker stops
+        self.tracker.touch(self.users[1], now=self.start)
+        self.tracker.stop()
+        self.assertEqual([u.last_seen for u in
+                          User.query.order_by(User.id).limit(2)],
+                         [self.start, self.start])
+
+    def test_requests_do_not_write(self):
+        u = self.users[0]
+        u.set_password('password')
+        u.last_seen = datetime.utcnow() - timedelta(minutes=10)
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': u.username,
+                                         'password': 'password'})
+        with QueryCounter() as queries:
+            for _ in range(3):
+                self.assertEqual(client.get('/explore').status_code, 200)
+        self.assertEqual(queries.writes(), [])
+        self.assertEqual(self.tracker.flush(), 1)
+
+
+class FeedQueryCountCase(unittest.TestCase):
+    """Tests that rendering a full page of a feed runs a fixed number of SQL
+    statements, whatever the number of distinct authors on the page"""
+
+    # user loader, feed query, unread messages badge and a few one-off
+    # lookups (profile owner, follow status, messages notification)
+    MAX_QUERIES = 8
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        per_page = self.app.config['POSTS_PER_PAGE']
+        self.users = [User(username='user{}'.format(i),
+                           email='user{}@example.com'.format(i))
+                      for i in range(per_page + 1)]
+        db.session.add_all(self.users)
+        self.me = self.users[0]
+        self.me.set_password('password')
+        now = datetime.utcnow()
+        for i, u in enumerate(self.users):
+            db.session.add(Post(body='post from {}'.format(u.username),
+                                author=u, timestamp=now + timedelta(i)))
+            db.session.add(Message(body='hi', author=u, recipient=self.me,
+                                   timestamp=now + timedelta(i)))
+        db.session.commit()
+        for u in self.users[1:]:
+            self.me.follow(u)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': self.me.username,
+                                              'password': 'password'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def assertQueryCount(self, url):
+        with QueryCounter() as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(queries.count, self.MAX_QUERIES,
+                             '{} ran {} queries'.format(url, queries.count))
+        return response
+
+    def test_feeds(self):
+        for url in ['/index', '/explore', '/messages']:
+            response = self.assertQueryCount(url)
+            self.assertEqual(response.data.count(b'user_avatar'),
+                             self.app.config['POSTS_PER_PAGE'])
+        self.assertQueryCount('/user/user0')
+
+
+class SearchIndexCase(unittest.TestCase):
+    """Tests for the search index updates"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['SEARCH_BACKEND'] = 'elasticsearch'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.es = self.app.elasticsearch = FakeElasticsearch()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_commit_sends_one_bulk_request(self):
+        posts = [Post(body='post number {}'.format(i), author=self.user)
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(self.es.requests, [('bulk', 10)])
+        self.assertEqual(len(self.es.documents), 5)
+
+        self.es.requests = []
+        posts[0].body = 'edited post'
+        db.session.delete(posts[1])
+        db.session.commit()
+        self.assertEqual(self.es.requests, [('bulk', 3)])
+        self.assertEqual(self.es.documents[('post', str(posts[0].id))],
+                         {'body': 'edited post'})
+        self.assertEqual(len(self.es.documents), 4)
+
+        results, total = Post.search('edited', 1, 10)
+        self.assertEqual(total, 1)
+        self.assertEqual(results.all(), [posts[0]])
+
+    def test_reindex_in_batches(self):
+        self.app.elasticsearch = None
+        db.session.add_all([Post(body='post {}'.format(i), author=self.user)
+                            for i in range(7)])
+        db.session.commit()
+        self.app.elasticsearch = self.es
+        progress = []
+        self.assertEqual(Post.reindex(batch_size=3, progress=progress.append),
+                         7)
+        self.assertEqual(progress, [3, 6, 7])
+        self.assertEqual(self.es.requests,
+                         [('bulk', 6), ('bulk', 6), ('bulk', 2)])
+        self.assertEqual(len(self.es.documents), 7)
+
+    def test_search_unavailable(self):
+        breaker = self.app.circuit_breakers['elasticsearch']
+        self.es.fail = True
+        for i in range(breaker.failure_threshold + 1):
+            results, total = Post.search('hello', 1, 10)
+            self.assertEqual((results.all(), total), ([], 0))
+        self.assertEqual(len(self.es.requests), breaker.failure_threshold)
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(len(self.app.search_cache), 0)
+
+        # the writes still commit, and queue their index updates in the outbox
+        post = Post(body='hello', author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(Post.query.count(), 1)
+        self.assertEqual([(entry.action, entry.index, entry.object_id)
+                          for entry in SearchOutbox.query],
+                         [('index', 'post', post.id)])
+        breaker.reset_timeout = 0
+        self.es.fail = False
+        self.assertEqual(SearchOutbox.drain(), 1)
+        self.assertIn(('post', str(post.id)), self.es.documents)
+
+    def test_flushed_posts_indexed(self):
+        post = Post(body='flushed post', author=self.user)
+        db.session.add(post)
+        db.session.flush()
+        db.session.commit()
+        self.assertEqual(self.es.requests, [('bulk', 2)])
+        self.assertIn(('post', str(post.id)), self.es.documents)
+
+
+class SearchOutboxCase(unittest.TestCase):
+    """Tests for the search index updates sent through the outbox"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['SEARCH_OUTBOX'] = True
+        self.app.config['SEARCH_BACKEND'] = 'elasticsearch'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.es = self.app.elasticsearch = FakeElasticsearch()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_outbox_written_with_commit(self):
+        posts = [Post(body='post {}'.format(i), author=self.user)
+                 for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(self.es.requests, [])
+        self.assertEqual(SearchOutbox.query.count(), 3)
+
+        # the latest update of a document wins
+        db.session.delete(posts[0])
+        db.session.commit()
+        self.assertEqual(SearchOutbox.drain(), 4)
+        self.assertEqual(self.es.requests, [('bulk', 5)])
+        self.assertEqual(sorted(self.es.documents),
+                         [('post', str(p.id)) for p in posts[1:]])
+        self.assertEqual(SearchOutbox.query.count(), 0)
+        self.assertEqual(SearchOutbox.drain(), 0)
+
+    def test_retry_with_backoff(self):
+        post = Post(body='a post', author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        self.es.fail = True
+        self.assertEqual(SearchOutbox.drain(), 1)
+        entry = SearchOutbox.query.one()
+        self.assertEqual(entry.attempts, 1)
+        self.assertGreater(entry.next_attempt, time.time())
+
+        # nothing is due until the backoff delay has passed
+        self.assertEqual(SearchOutbox.drain(), 0)
+        entry.next_attempt = 0
+        db.session.commit()
+        self.es.fail = False
+        self.assertEqual(SearchOutbox.drain(), 1)
+        self.assertIn(('post', str(post.id)), self.es.documents)
+        self.assertEqual(SearchOutbox.query.count(), 0)
+
+    def test_background_worker(self):
+        from blog.workers import BackgroundWorker
+        db.session.add(Post(body='a post', author=self.user))
+        db.session.commit()
+        worker = BackgroundWorker(self.app, SearchOutbox.drain, 0.01)
+        worker.start()
+        for _ in range(100):
+            if self.es.documents:
+                break
+            time.sleep(0.01)
+        worker.stop()
+        self.assertEqual(len(self.es.documents), 1)
+
+
+class LanguageCase(unittest.TestCase):
+    """Tests for the language detection of the posts"""
+
+    english = 'The quick brown fox jumps over the lazy dog again today'
+    spanish = 'El rápido zorro marrón salta sobre el perro perezoso hoy'
+
+    def setUp(self):
+        self.app = create_app(FileDatabaseConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        self.user.set_password('password')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_post_view_defers_detection(self):
+        from blog.language import detect_pending
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john',
+                                         'password': 'password'})
+        client.post('/', data={'post': self.english})
+        post = Post.query.one()
+        self.assertIsNone(post.language)
+        self.assertEqual(detect_pending(), 1)
+        db.session.refresh(post)
+        self.assertEqual(post.language, 'en')
+        self.assertEqual(detect_pending(), 0)
+
+    def test_worker_woken_by_commit(self):
+        from blog.language import detect_pending
+        from blog.workers import BackgroundWorker
+        worker = self.app.language_worker = BackgroundWorker(
+            self.app, detect_pending, 3600)
+        worker.start()
+        post = Post(body=self.spanish, author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        for _ in range(100):
+            if db.session.query(Post.language).scalar():
+                break
+            time.sleep(0.01)
+        worker.stop()
+        self.assertEqual(db.session.query(Post.language).scalar(), 'es')
+
+    def test_backfill(self):
+        from blog.language import backfill
+        db.session.add_all(
+            [Post(body=self.english, author=self.user) for i in range(3)] +
+            [Post(body=self.spanish, author=self.user) for i in range(2)] +
+            [Post(body='hi', author=self.user),
+             Post(body=self.spanish, author=self.user, language='en')])
+        db.session.commit()
+        progress = []
+        with QueryCounter() as queries:
+            self.assertEqual(backfill(processes=2, chunk_size=2,
+                                      progress=progress.append), 6)
+        self.assertEqual(progress, [2, 4, 6])
+        self.assertEqual(len(queries.writes()), 3)
+        self.assertEqual(
+            [post.language for post in Post.query.order_by(Post.id)],
+            ['en', 'en', 'en', 'es', 'es', '', 'en'])
+
+
+class EmailQueueCase(unittest.TestCase):
+    """Tests for the outgoing email queue"""
+
+    def setUp(self):
+        self.smtp = FakeSMTPServer()
+
+        class EmailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = self.smtp.port
+            MAIL_SUPPRESS_SEND = False
+            EMAIL_WORKERS = 1
+            EMAIL_RETRY_DELAY = 0.01
+
+        self.app = create_app(EmailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.queue = self.app.email_queue
+
+    def tearDown(self):
+        self.queue.stop()
+        self.app_context.pop()
+        self.smtp.close()
+
+    def send(self, count):
+        from blog.email import send_email
+        for i in range(count):
+            self.assertTrue(send_email(
+                'Hello', 'admin@example.com', ['user{}@example.com'.format(i)],
+                'text', '<p>html</p>'))
+
+    def test_batches_share_connections(self):
+        self.send(10)
+        self.queue.flush()
+        self.assertEqual(len(self.smtp.messages), 10)
+        self.assertLess(self.smtp.connections, 5)
+        stats = self.queue.stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['depth']),
+                         (10, 0, 0))
+
+    def test_transient_failure_retried(self):
+        self.smtp.fail = 2
+        self.send(3)
+        self.queue.flush()
+        self.assertEqual(sorted(r for r, _ in self.smtp.messages), [
+            ['user0@example.com'], ['user1@example.com'],
+            ['user2@example.com']])
+        self.assertEqual(self.queue.stats()['retried'], 2)
+        self.assertEqual(self.queue.stats()['failed'], 0)
+
+    def test_retries_exhausted(self):
+        self.smtp.fail = 100
+        self.send(1)
+        self.queue.flush()
+        self.assertEqual(self.smtp.messages, [])
+        self.assertEqual(self.queue.stats()['retried'], 3)
+        self.assertEqual(self.queue.stats()['failed'], 1)
+
+    def test_backpressure(self):
+        from blog.email import send_email
+        self.smtp.delay = 0.2
+        self.queue._queue.maxsize = 2
+        self.queue.put_timeout = 0.05
+        results = [send_email('Hello', 'admin@example.com',
+                              ['user@example.com'], 'text', 'html')
+                   for i in range(5)]
+        self.assertIn(False, results)
+        self.assertEqual(self.queue.stats()['rejected'], results.count(False))
+        self.assertLessEqual(self.queue.stats()['max_depth'], 2)
+
+    def test_stop_flushes_queue(self):
+        self.smtp.delay = 0.01
+        self.send(5)
+        self.queue.stop()
+        self.assertEqual(len(self.smtp.messages), 5)
+        self.assertEqual(self.queue.stats()['workers'], 0)
+
+
+class FragmentCacheCase(unittest.TestCase):
+    """Tests for the rendered fragments cache"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        self.user.set_password('password')
+        self.post = Post(body='first post', author=self.user)
+        db.session.add_all([self.user, self.post])
+        db.session.commit()
+        self.fragments = self.app.fragment_cache
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def render(self, locale='en'):
+        from flask import g
+        from blog.fragments import render_fragment
+        with self.app.test_request_context():
+            g.locale = locale
+            return render_fragment('_post.html', post=self.post,
+                                   depends_on=[self.post.author])
+
+    def test_post_fragment(self):
+        html = self.render()
+        self.assertIn('first post', html)
+        self.assertEqual(self.render(), html)
+        self.assertEqual(self.fragments.stats(), {'hits': 1, 'misses': 1})
+        self.render(locale='ar')
+        self.assertEqual(self.fragments.stats()['misses'], 2)
+
+        # the fragment is invalidated when the post or its author change
+        self.post.body = 'edited post'
+        db.session.commit()
+        self.assertIn('edited post', self.render())
+        self.user.username = 'johnny'
+        db.session.commit()
+        self.assertIn('johnny', self.render())
+        self.assertEqual(self.fragments.stats(), {'hits': 1, 'misses': 4})
+
+        # and so is it by the bulk updates of the language detection
+        from blog.language import update_languages
+        update_languages({self.post.id: 'es'})
+        db.session.commit()
+        self.assertIn('translation{}'.format(self.post.id), self.render())
+
+    def test_popup_validators(self):
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add(susan)
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john',
+                                         'password': 'password'})
+        response = client.get('/user/susan/popup')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'0 followers', response.data)
+        self.assertEqual(response.headers['Cache-Control'],
+                         'private, max-age=60')
+        etag = response.headers['ETag']
+        response = client.get('/user/susan/popup',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # following the user changes the popup
+        self.user.follow(susan)
+        db.session.commit()
+        response = client.get('/user/susan/popup',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'1 followers', response.data)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # and so does the CSRF token it holds, once it gets old
+        etag = response.headers['ETag']
+        self.app.config['WTF_CSRF_TIME_LIMIT'] = 0.02
+        time.sleep(0.02)
+        response = client.get('/user/susan/popup',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+
+class ConditionalGetCase(unittest.TestCase):
+    """Tests for the conditional GET requests of the feeds, profiles and
+    notifications"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('password')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.add_all([Post(body='post {}'.format(i), author=self.susan)
+                            for i in range(5)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'password'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url, **headers):
+        """Returns the response to a GET request and the number of SQL
+        statements it took."""
+        db.session.remove()
+        with QueryCounter() as queries:
+            response = self.client.get(url, headers=headers)
+        return response, len(queries.statements)
+
+    def test_explore(self):
+        response, full = self.get('/explore')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response.headers['Cache-Control'])
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+        self.assertNotIn('Last-Modified', response.headers)
+        response, conditional = self.get('/explore', If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        # only the user is read, the newest post is in the recent posts
+        self.assertEqual(conditional, 1)
+        self.assertLess(conditional, full)
+
+        # a modification time can't stand for the whole entity tag, so
+        # If-Modified-Since alone is never answered with a 304
+        response, _ = self.get('/explore',
+                               If_Modified_Since=http_date(time.time()))
+        self.assertEqual(response.status_code, 200)
+
+        db.session.add(Post(body='new post', author=self.susan))
+        db.session.commit()
+        response, _ = self.get('/explore', If_None_Match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'new post', response.data)
+
+    def test_user_and_index(self):
+        etags = {}
+        for url in ('/user/susan', '/index'):
+            response, _ = self.get(url)
+            etags[url] = response.headers['ETag']
+            response, _ = self.get(url, If_None_Match=etags[url])
+            self.assertEqual(response.status_code, 304)
+
+        # following susan changes both pages (the first page shows the flashed
+        # message, which is never validated)
+        self.client.post('/follow/susan')
+        response, _ = self.get('/explore', If_None_Match=etags['/index'])
+        self.assertNotIn('ETag', response.headers)
+        for url in ('/user/susan', '/index'):
+            response, _ = self.get(url, If_None_Match=etags[url])
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etags[url])
+
+    def test_profile_change(self):
+        response, _ = self.get('/user/susan')
+        etag = response.headers['ETag']
+        User.by_username('susan').about_me = 'new about me'
+        db.session.commit()
+        response, _ = self.get('/user/susan', If_None_Match=etag,
+                               If_Modified_Since=http_date(time.time()))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'new about me', response.data)
+
+    def test_rename(self):
+        response, _ = self.get('/explore')
+        etag = response.headers['ETag']
+        self.client.post('/edit_profile', data={'username': 'johnny',
+                                                'about_me': ''})
+        self.get('/index')  # shows the flashed message
+        response, _ = self.get('/explore', If_None_Match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'/user/johnny', response.data)
+
+    def test_notifications(self):
+        response, _ = self.get('/notifications?since=0')
+        etag = response.headers['ETag']
+        response, queries = self.get('/notifications?since=0',
+                                     If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.john.add_notification('unread_message_count', 1)
+        db.session.commit()
+        response, _ = self.get('/notifications?since=0', If_None_Match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()), 1)
+
+        # the long polling requests are never answered with a 304
+        response, _ = self.get('/notifications?since=0&wait=0.01',
+                               If_None_Match=response.headers['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+class CacheCase(unittest.TestCase):
+    """Tests for the in-process cache"""
+
+    def test_lru(self):
+        cache = Cache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'size': 2})
+        self.assertEqual(cache.delete_where(lambda key: key == 'a'), 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_ttl(self):
+        cache = Cache(ttl=0.01)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a', 'expired'), 'expired')
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        cache = Cache(maxsize=0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class DatabaseSearchCase(unittest.TestCase):
+    """Tests for the database full-text search backend"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['SEARCH_BACKEND'] = 'database'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_search(self):
+        p1 = Post(body='the quick brown fox', author=self.user)
+        p2 = Post(body='the lazy dog', author=self.user)
+        p3 = Post(body='a fox and a dog', author=self.user)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts.all()), {p1, p3})
+
+        # the index follows updates and deletes in the same transaction
+        p1.body = 'the quick brown cat'
+        db.session.delete(p3)
+        db.session.commit()
+        posts, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 0)
+        posts, total = Post.search('cat dog', 1, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(posts.all()), 1)
+
+        # query syntax is searched as plain words
+        posts, total = Post.search('"cat OR', 1, 10)
+        self.assertEqual(total, 1)
+        self.assertEqual(Post.reindex(), 2)
+
+    def test_search_view(self):
+        self.user.set_password('password')
+        db.session.add(Post(body='hello world', author=self.user))
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john',
+                                         'password': 'password'})
+        response = client.get('/search?q=world')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'hello world', response.data)
+
+    def test_search_cache(self):
+        db.session.add(Post(body='hello world', author=self.user))
+        db.session.commit()
+        cache = self.app.search_cache
+        self.assertEqual(Post.search('World', 1, 10)[1], 1)
+        with QueryCounter() as queries:
+            posts, total = Post.search('  world ', 1, 10)
+        self.assertEqual(total, 1)
+        self.assertEqual(queries.count, 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # committing a searchable change drops the cached results
+        db.session.add(Post(body='another world', author=self.user))
+        db.session.commit()
+        self.assertEqual(Post.search('world', 1, 10)[1], 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+
+class NotificationsCase(unittest.TestCase):
+    """Tests for the long polling notifications view"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        self.user.set_password('password')
+        db.session.add(self.user)
+        db.session.commit()
+        self.user_id = self.user.id
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'password'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def notify(self, delay):
+        time.sleep(delay)
+        with self.app.app_context():
+            User.query.get(self.user_id).add_notification(
+                'unread_message_count', 3)
+            db.session.commit()
+
+    def test_since(self):
+        self.user.add_notification('unread_message_count', 1)
+        db.session.commit()
+        notifications = self.client.get('/notifications?since=0').get_json()
+        self.assertEqual([n['data'] for n in notifications], [1])
+        since = notifications[0]['timestamp']
+        self.assertEqual(self.client.get(
+            '/notifications?since={}'.format(since)).get_json(), [])
+
+    def test_upsert_coalesces_notifications(self):
+        with QueryCounter() as queries:
+            for count in range(3):
+                self.user.add_notification('unread_message_count', count)
+            db.session.commit()
+        self.assertEqual(len(queries.writes()), 1)
+        self.assertIn('ON CONFLICT', queries.writes()[0])
+        notification = Notification.query.one()
+        self.assertEqual(notification.get_data(), 2)
+
+        # a later notification updates the same row
+        self.user.add_notification('unread_message_count', 5)
+        db.session.commit()
+        self.assertEqual(Notification.query.one().id, notification.id)
+        self.assertEqual(Notification.query.one().get_data(), 5)
+
+        # nothing is written when the session is rolled back
+        self.user.add_notification('unread_message_count', 6)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(Notification.query.one().get_data(), 5)
+
+    def test_wait_times_out(self):
+        start = time.time()
+        response = self.client.get('/notifications?since=0&wait=0.05')
+        self.assertEqual(response.get_json(), [])
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(self.app.notification_broker.subscriber_count(), 0)
+
+    def test_send_message_notification(self):
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add(susan)
+        db.session.commit()
+        for _ in range(2):
+            self.client.post('/send_message/susan', data={'message': 'hi'})
+        db.session.expire_all()
+        self.assertEqual(susan.new_messages(), 2)
+        self.assertEqual([n.get_data() for n in susan.notifications], [2])
+
+    def test_wait_woken_by_commit(self):
+        publisher = Thread(target=self.notify, args=(0.1,))
+        publisher.start()
+        start = time.time()
+        response = self.client.get('/notifications?since=0&wait=10')
+        publisher.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([n['data'] for n in response.get_json()], [3])
+
+
+class TranslationCacheCase(unittest.TestCase):
+    """Tests for the translation cache in memory and in the database"""
+
+    def setUp(self):
+        self.translator = FakeTranslator()
+        self.app = create_app(TestConfig)
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = self.translator.url
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.translator.close()
+
+    def test_translation_cached(self):
+        from blog.translate import translate
+        self.assertEqual(translate('hello', 'ar', 'en'), 'ar: hello')
+        self.assertEqual(translate('hello', 'ar', 'en'), 'ar: hello')
+        self.assertEqual(len(self.translator.requests), 1)
+        self.assertEqual(Translation.query.count(), 1)
+
+        # the database keeps the translation for the other processes
+        self.app.translation_cache.memory.clear()
+        self.assertEqual(translate('hello', 'ar', 'en'), 'ar: hello')
+        self.assertEqual(len(self.translator.requests), 1)
+        self.assertEqual(self.app.translation_cache.stats(), {
+            'memory_hits': 1, 'memory_misses': 2,
+            'db_hits': 1, 'db_misses': 1})
+
+        # the languages are part of the key
+        self.assertEqual(translate('hello', 'en', 'ar'), 'en: hello')
+        self.assertEqual(len(self.translator.requests), 2)
+
+    def test_set_outside_session(self):
+        cache = self.app.translation_cache
+        key = cache.key('hello', 'ar', 'en')
+        db.session.add(User(username='john', email='john@example.com'))
+        cache.set(key, 'first')
+        # the pending changes of the session are left alone
+        db.session.rollback()
+        self.assertEqual(User.query.count(), 0)
+        cache.memory.clear()
+        self.assertEqual(cache.get(key), 'first')
+
+        # a translation stored meanwhile is replaced
+        cache.set_many({key: 'second', cache.key('world', 'ar'): 'third'})
+        cache.memory.clear()
+        self.assertEqual(cache.get(key), 'second')
+        self.assertEqual(Translation.query.count(), 2)
+
+    def test_failure_not_cached(self):
+        from blog.translate import translate
+        self.translator.fail = True
+        self.assertEqual(translate('hello', 'ar'), 'hello')
+        self.translator.fail = False
+        self.assertEqual(translate('hello', 'ar'), 'ar: hello')
+        self.assertEqual(len(self.translator.requests), 2)
+
+    def test_translate_posts(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('password')
+        posts = [Post(body='hello', author=u, language='en'),
+                 Post(body='world', author=u, language='en'),
+                 Post(body='salut', author=u, language='fr'),
+                 Post(body='hello', author=u, language='en')]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        from blog.translate import translate
+        translate('hello', 'ar', 'en')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john',
+                                         'password': 'password'})
+        response = client.post('/translate/posts', json={
+            'posts': [post.id for post in posts], 'dest_language': 'ar'})
+        self.assertEqual(response.get_json()['translations'], {
+            str(posts[0].id): 'ar: hello', str(posts[1].id): 'ar: world',
+            str(posts[2].id): 'ar: salut', str(posts[3].id): 'ar: hello'})
+
+        # the two texts missing from the cache are sent in one request
+        self.assertEqual(len(self.translator.requests), 2)
+        path, body = self.translator.requests[1]
+        self.assertEqual(body, [{'Text': 'world'}, {'Text': 'salut'}])
+        self.assertNotIn('from=', path)
+
+        # the text of a post read from its page shares the cache entry
+        response = client.post('/translate', data={
+            'text': '\n\t hello\n  ', 'source_language': 'en',
+            'dest_language': 'ar'})
+        self.assertEqual(response.get_json()['text'], 'ar: hello')
+        self.assertEqual(len(self.translator.requests), 2)
+
+        # malformed requests are rejected
+        for payload in (['posts'], {'posts': 1}, {'posts': ['x']},
+                        {'posts': [{}]}, {'posts': [1], 'dest_language': 1}):
+            response = client.post('/translate/posts', json=payload)
+            self.assertEqual(response.status_code, 400)
+        response = client.post('/translate/posts', data='{',
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_warm_command(self):
+        from blog import cli
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([
+            u, Post(body='hello', author=u, language='en'),
+            Post(body='marhaba', author=u, language='ar'),
+            Post(body='unknown', author=u, language='')])
+        db.session.commit()
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(
+            args=['translate', 'warm'])
+        self.assertIn('2 translations warmed', result.output)
+        self.assertEqual(Translation.query.count(), 2)
+
+
+class ServiceClientConfig(TestConfig):
+    MS_TRANSLATOR_KEY = 'key'
+    TRANSLATOR_TIMEOUT = 0.2
+    CIRCUIT_BREAKER_THRESHOLD = 2
+
+
+class ServiceClientCase(unittest.TestCase):
+    """Tests for the keep-alive connections, timeouts and circuit breakers of
+    the clients of the external services"""
+
+    def setUp(self):
+        self.translator = FakeTranslator()
+        self.app = create_app(ServiceClientConfig)
+        self.app.config['MS_TRANSLATOR_URL'] = self.translator.url
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.translator.close()
+
+    def test_keep_alive(self):
+        from blog.translate import translate
+        translate('hello', 'ar')
+        translate('world', 'ar')
+        self.assertEqual(len(self.translator.ports), 2)
+        self.assertEqual(len(set(self.translator.ports)), 1)
+
+    def test_timeout(self):
+        from blog.translate import translate
+        self.translator.delay = 1
+        start = time.monotonic()
+        self.assertEqual(translate('hello', 'ar'), 'hello')
+        self.assertLess(time.monotonic() - start, 0.8)
+        self.assertEqual(Translation.query.count(), 0)
+        self.assertEqual(self.app.translator.stats()['failures'], 1)
+
+    def test_circuit_breaker(self):
+        from blog.translate import translate
+        breaker = self.app.circuit_breakers['translator']
+        self.translator.fail = True
+        for text in ('one', 'two', 'three'):
+            self.assertEqual(translate(text, 'ar'), text)
+        # the third translation doesn't reach the failing service
+        self.assertEqual(len(self.translator.requests), 2)
+        self.assertEqual(breaker.stats(), {
+            'state': 'open', 'successes': 0, 'failures': 2, 'rejected': 1,
+            'opened': 1})
+
+        # once the reset timeout has passed a trial request is let through
+        breaker.reset_timeout = 0
+        self.assertEqual(breaker.state, 'half-open')
+        self.translator.fail = False
+        self.assertEqual(translate('four', 'ar'), 'ar: four')
+        self.assertEqual(breaker.state, 'closed')
+
+        # a failing trial request opens the breaker again at once
+        self.translator.fail = True
+        translate('five', 'ar')
+        translate('six', 'ar')
+        self.assertEqual(breaker.opened, 2)
+        self.assertEqual(breaker.state, 'half-open')
+        requests = len(self.translator.requests)
+        self.assertEqual(translate('seven', 'ar'), 'seven')
+        self.assertEqual(len(self.translator.requests), requests + 1)
+        breaker.reset_timeout = 30
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.opened, 3)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)